@@ -0,0 +1,202 @@
+import argparse
+import json
+import time
+import tracemalloc
+
+import rl
+
+#############################################
+# Turn-throughput benchmark for the core game loop.
+# Runs headless games (see rl.run_headless) and reports turns/sec, ms per turn,
+# time spent in each subsystem, the memory each monster or item takes, how
+# often the chase distances, paths and monster fields of view were computed and, optionally,
+# memory allocations.
+#
+#   python bench.py --turns 2000 --games 5 --rooms 200 --density 2
+#############################################
+
+# Subsystems to time: name -> (object holding the function, attribute name).
+# Times are inclusive, e.g. 'ai' includes the is_blocked calls made by monsters.
+SUBSYSTEMS = [
+  ('mapgen', rl, 'make_map'),
+  ('fov', rl, 'update_fov'),
+  ('render', rl, 'render_all'),
+  ('ai', rl.AI_BasicMonster, 'take_turn'),
+  ('ai', rl.AI_ConfusedMonster, 'take_turn'),
+  ('monster_fov', rl.VisibilityService, 'read_view'),
+  ('is_blocked', rl, 'is_blocked'),
+  ('messages', rl, 'message'),
+]
+
+stats = {}
+
+class Plain:
+  # An object with a __dict__, as game objects and their components were before they got __slots__.
+  pass
+
+def entity_bytes(count = 500):
+  # Average bytes per monster or item (object and components) spawned from the templates, with __slots__ as
+  # now and with a __dict__ per object as before. Returns {'slots': ..., 'dict': ...}.
+  templates = rl.load_templates()
+  templates = templates['monsters'] + templates['items']
+  def measure(make):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    kept = [make(template) for template in templates for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return used / len(kept)
+  return {'slots': measure(lambda template: template.spawn(0, 0)), 'dict': measure(lambda template: plain_copy(template.prototype))}
+
+def install_timers():
+  # Wrap each subsystem's function so every call is counted and timed. Returns a function that removes the wrappers.
+  originals = []
+  for (name, owner, attr) in SUBSYSTEMS:
+    function = getattr(owner, attr)
+    originals.append((owner, attr, function))
+    setattr(owner, attr, timed(name, function))
+  def uninstall():
+    for (owner, attr, function) in originals:
+      setattr(owner, attr, function)
+  return uninstall
+
+def timed(name, function):
+  # Returns a wrapper of 'function' that adds its calls and time to stats[name].
+  clock = time.perf_counter
+  def wrapper(*args, **kwargs):
+    start = clock()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      entry = stats[name]
+      entry[0] += 1
+      entry[1] += clock() - start
+  return wrapper
+
+def run(turns = 1000, games = 3, width = None, height = None, rooms = None, density = None, render = False, allocations = False, seed = None):
+  # Play 'games' games of 'turns' random moves each and return the measurements as a dict. With a seed, the
+  # games and moves are the same on every run.
+  if width is not None:
+    rl.MAP_WIDTH = width
+  if height is not None:
+    rl.MAP_HEIGHT = height
+  if rooms is not None:
+    rl.MAX_ROOMS = rooms
+  if density is not None:
+    rl.MONSTER_DENSITY = density
+  # Rendering needs a real window; otherwise only the game logic runs.
+  rl.init_console(headless_mode = not render)
+  stats.clear()
+  for (name, owner, attr) in SUBSYSTEMS:
+    stats[name] = [0, 0.0]
+  uninstall = install_timers()
+  rl.paths.hits = rl.paths.misses = 0
+  rl.flow.computes = 0
+  rl.visibility.hits = rl.visibility.misses = 0
+  entity = entity_bytes()
+  if allocations:
+    tracemalloc.start()
+  total_turns = 0
+  play_time = 0.0
+  monsters = 0
+  try:
+    for game in range(games):
+      game_seed = seed + game if seed is not None else None
+      rl.new_game(game_seed)
+      # Keep the player alive so every game lasts the full number of turns.
+      rl.player.fighter.base_max_hp = rl.player.fighter.hp = 10 ** 9
+      monsters += len([obj for obj in rl.gameobjects if obj.ai])
+      start = time.perf_counter()
+      if render:
+        total_turns += run_rendered(rl.random_moves(turns, game_seed))
+      else:
+        total_turns += rl.run_headless(rl.random_moves(turns, game_seed))
+      play_time += time.perf_counter() - start
+  finally:
+    uninstall()
+  results = {
+    'map': [rl.MAP_WIDTH, rl.MAP_HEIGHT],
+    'max_rooms': rl.MAX_ROOMS,
+    'monster_density': rl.MONSTER_DENSITY,
+    'games': games,
+    'seed': seed,
+    'turns': total_turns,
+    'monsters_per_level': monsters / games,
+    'turns_per_sec': total_turns / play_time if play_time else 0.0,
+    'ms_per_turn': 1000.0 * play_time / total_turns if total_turns else 0.0,
+    'subsystems': {},
+    'bytes_per_entity': entity,
+    'path_cache': {'hits': rl.paths.hits, 'misses': rl.paths.misses},
+    'flow_field_computes': rl.flow.computes,
+    'visibility_cache': {'hits': rl.visibility.hits, 'misses': rl.visibility.misses},
+  }
+  for (name, (calls, seconds)) in stats.items():
+    results['subsystems'][name] = {'calls': calls, 'ms': 1000.0 * seconds, 'ms_per_turn': 1000.0 * seconds / max(total_turns, 1)}
+  if allocations:
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results['allocations'] = {'current_kb': current / 1024.0, 'peak_kb': peak / 1024.0}
+  return results
+
+def run_rendered(events):
+  # Like rl.run_headless, but draws and flushes every frame, as play_game does.
+  rl.input_script = rl.ScriptedInput(events)
+  rl.mouse = rl.libtcod.Mouse()
+  rl.key = rl.libtcod.Key()
+  rl.render_invalidate()
+  turns = 0
+  while rl.game_state == 'playing' and not rl.input_script.exhausted():
+    rl.poll_input()
+    rl.render_all()
+    rl.libtcod.console_flush()
+    rl.check_level_up()
+    if rl.play_turn() != 'didnt-take-turn':
+      turns += 1
+  return turns
+
+def plain_copy(obj):
+  # A Plain copy of a slotted object and its components.
+  copy = Plain()
+  for (name, value) in rl.slot_values(obj):
+    if getattr(value, 'owner', None) is obj:
+      value = plain_copy(value)
+      value.owner = copy
+    setattr(copy, name, value)
+  return copy
+
+def report(results):
+  # Print the results as a small table.
+  print('map %dx%d, max rooms %d, monster density %.2f, %.1f monsters per level' % (results['map'][0], results['map'][1],
+    results['max_rooms'], results['monster_density'], results['monsters_per_level']))
+  print('%d turns over %d games: %.1f turns/sec, %.3f ms per turn' % (results['turns'], results['games'],
+    results['turns_per_sec'], results['ms_per_turn']))
+  print('%-12s %10s %12s %12s' % ('subsystem', 'calls', 'total ms', 'ms/turn'))
+  for (name, entry) in results['subsystems'].items():
+    print('%-12s %10d %12.2f %12.4f' % (name, entry['calls'], entry['ms'], entry['ms_per_turn']))
+  print('bytes per monster or item: %.0f with __slots__, %.0f with a __dict__' % (results['bytes_per_entity']['slots'], results['bytes_per_entity']['dict']))
+  paths = results['path_cache']
+  print('distance map computed %d times; monster paths: %d followed, %d computed' % (results['flow_field_computes'],
+    paths['hits'], paths['misses']))
+  views = results['visibility_cache']
+  print('monster fields of view: %d from the cache, %d computed' % (views['hits'], views['misses']))
+  if 'allocations' in results:
+    print('allocations: %.1f KB still held, %.1f KB peak' % (results['allocations']['current_kb'], results['allocations']['peak_kb']))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Measure how fast the game advances.')
+  parser.add_argument('--turns', type = int, default = 1000, help = 'turns per game')
+  parser.add_argument('--games', type = int, default = 3)
+  parser.add_argument('--width', type = int, help = 'map width')
+  parser.add_argument('--height', type = int, help = 'map height')
+  parser.add_argument('--rooms', type = int, help = 'MAX_ROOMS')
+  parser.add_argument('--density', type = float, help = 'MONSTER_DENSITY')
+  parser.add_argument('--render', action = 'store_true', help = 'open a window and time rendering too')
+  parser.add_argument('--alloc', action = 'store_true', help = 'trace memory allocations (slower)')
+  parser.add_argument('--seed', type = int, help = 'play the same games on every run')
+  parser.add_argument('--json', help = 'also write the results to this file')
+  args = parser.parse_args()
+  results = run(args.turns, args.games, args.width, args.height, args.rooms, args.density, args.render, args.alloc, args.seed)
+  report(results)
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent = 2)
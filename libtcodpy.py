@@ -27,6 +27,8 @@
 
 import sys
 import ctypes
+import math
+import random as _random
 import struct
 from ctypes import *
 
@@ -1403,6 +1405,63 @@ DISTRIBUTION_GAUSSIAN_RANGE = 2
 DISTRIBUTION_GAUSSIAN_INVERSE = 3
 DISTRIBUTION_GAUSSIAN_RANGE_INVERSE = 4
 
+class BufferedRandom(object):
+    # A generator that draws its numbers in blocks, in Python, instead of making a ctypes call per number.
+    # Create one with random_new_buffered; the random_get_* functions take it in place of a TCOD generator
+    # and give the same distributions (not the same numbers).
+    def __init__(self, seed, block=1024):
+        self.generator = _random.Random(seed)
+        self.block = block
+        self.unpack = struct.Struct('<%dI' % block).unpack
+        self.values = ()
+        self.position = 0
+        self.distribution = DISTRIBUTION_LINEAR
+
+    def next(self):
+        # The next 32-bit number, refilling the buffer from one getrandbits call when it runs out.
+        if self.position == len(self.values):
+            self.values = self.unpack(self.generator.getrandbits(32 * self.block).to_bytes(4 * self.block, 'little'))
+            self.position = 0
+        value = self.values[self.position]
+        self.position += 1
+        return value
+
+    def integer(self, mi, ma):
+        if mi > ma:
+            mi, ma = ma, mi
+        return mi + self.next() % (ma - mi + 1)
+
+    def uniform(self, mi, ma):
+        return mi + (ma - mi) * (self.next() / 4294967296.0)
+
+    def gaussian(self, mean, std_dev):
+        # Box-Muller transform of two uniform numbers.
+        u = (self.next() + 1) / 4294967297.0
+        v = self.next() / 4294967296.0
+        return mean + std_dev * math.sqrt(-2.0 * math.log(u)) * math.cos(2.0 * math.pi * v)
+
+    def draw(self, mi, ma, mean=None):
+        # A number following the distribution set with random_set_distribution, as libtcod interprets mi and
+        # ma for it; with a mean, the _mean variants' gaussian centered on it.
+        dist = self.distribution
+        if mean is None:
+            if dist == DISTRIBUTION_LINEAR:
+                return self.uniform(mi, ma)
+            if dist in (DISTRIBUTION_GAUSSIAN, DISTRIBUTION_GAUSSIAN_INVERSE):
+                # mi is the mean and ma the standard deviation.
+                num = self.gaussian(mi, ma)
+                if dist == DISTRIBUTION_GAUSSIAN_INVERSE:
+                    num += -3 * ma if num >= mi else 3 * ma
+                return num
+            mean = (mi + ma) / 2.0
+        if mi > ma:
+            mi, ma = ma, mi
+        std_dev = max(mean - mi, ma - mean) / 3.0
+        num = self.gaussian(mean, std_dev)
+        if dist in (DISTRIBUTION_GAUSSIAN_INVERSE, DISTRIBUTION_GAUSSIAN_RANGE_INVERSE):
+            num += -3 * std_dev if num >= mean else 3 * std_dev
+        return min(max(num, mi), ma)
+
 def random_get_instance():
     return _lib.TCOD_random_get_instance()
 
@@ -1412,34 +1471,62 @@ def random_new(algo=RNG_CMWC):
 def random_new_from_seed(seed, algo=RNG_CMWC):
     return _lib.TCOD_random_new_from_seed(algo,c_uint(seed))
 
+def random_new_buffered(seed, block=1024):
+    return BufferedRandom(seed, block)
+
 def random_set_distribution(rnd, dist) :
-	_lib.TCOD_random_set_distribution(rnd, dist)
+    if isinstance(rnd, BufferedRandom):
+        rnd.distribution = dist
+        return
+    _lib.TCOD_random_set_distribution(rnd, dist)
 
 def random_get_int(rnd, mi, ma):
+    if isinstance(rnd, BufferedRandom):
+        if rnd.distribution == DISTRIBUTION_LINEAR:
+            return rnd.integer(mi, ma)
+        return int(math.floor(rnd.draw(mi, ma) + 0.5))
     return _lib.TCOD_random_get_int(rnd, mi, ma)
 
 def random_get_float(rnd, mi, ma):
+    if isinstance(rnd, BufferedRandom):
+        return rnd.draw(mi, ma)
     return _lib.TCOD_random_get_float(rnd, c_float(mi), c_float(ma))
 
 def random_get_double(rnd, mi, ma):
+    if isinstance(rnd, BufferedRandom):
+        return rnd.draw(mi, ma)
     return _lib.TCOD_random_get_double(rnd, c_double(mi), c_double(ma))
 
 def random_get_int_mean(rnd, mi, ma, mean):
+    if isinstance(rnd, BufferedRandom):
+        return int(math.floor(rnd.draw(mi, ma, mean) + 0.5))
     return _lib.TCOD_random_get_int_mean(rnd, mi, ma, mean)
 
 def random_get_float_mean(rnd, mi, ma, mean):
+    if isinstance(rnd, BufferedRandom):
+        return rnd.draw(mi, ma, mean)
     return _lib.TCOD_random_get_float_mean(rnd, c_float(mi), c_float(ma), c_float(mean))
 
 def random_get_double_mean(rnd, mi, ma, mean):
+    if isinstance(rnd, BufferedRandom):
+        return rnd.draw(mi, ma, mean)
     return _lib.TCOD_random_get_double_mean(rnd, c_double(mi), c_double(ma), c_double(mean))
 
 def random_save(rnd):
+    if isinstance(rnd, BufferedRandom):
+        return (rnd.generator.getstate(), rnd.values, rnd.position, rnd.distribution)
     return _lib.TCOD_random_save(rnd)
 
 def random_restore(rnd, backup):
+    if isinstance(rnd, BufferedRandom):
+        (state, rnd.values, rnd.position, rnd.distribution) = backup
+        rnd.generator.setstate(state)
+        return
     _lib.TCOD_random_restore(rnd, backup)
 
 def random_delete(rnd):
+    if isinstance(rnd, BufferedRandom):
+        return
     _lib.TCOD_random_delete(rnd)
 
 ############################
@@ -1537,6 +1624,117 @@ def map_is_walkable(m, x, y):
 def map_delete(m):
     return _lib.TCOD_map_delete(m)
 
+# Bulk access to a map's cells. The layout of the cells in memory depends on the libtcod version (one byte of
+# bit fields per cell, or three bools), so it is found out once by setting two cells and looking at them.
+# Where it can't be, these functions fall back to one call per cell.
+class _CMap(Structure):
+    _fields_ = [('width', c_int),
+                ('height', c_int),
+                ('nbcells', c_int),
+                ('cells', c_void_p)]
+
+_map_layout = None
+_TO_BOOL = bytes([0]) + bytes([1]) * 255
+_FOV_BIT = bytes((i >> 2) & 1 for i in range(256))
+
+def _map_cells(m):
+    return cast(c_void_p(m), POINTER(_CMap)).contents
+
+def _map_get_layout():
+    global _map_layout
+    if _map_layout is None:
+        _map_layout = False
+        try:
+            m = map_new(2, 1)
+            map_set_properties(m, 0, 0, True, False)
+            map_set_properties(m, 1, 0, False, True)
+            cmap = _map_cells(m)
+            if (cmap.width, cmap.height, cmap.nbcells) == (2, 1, 2):
+                if string_at(cmap.cells, 2) == b'\x01\x02':
+                    _map_layout = 'bits'
+                elif string_at(cmap.cells, 6) == b'\x01\x00\x00\x00\x01\x00':
+                    _map_layout = 'bools'
+            map_delete(m)
+        except Exception:
+            _map_layout = False
+    return _map_layout
+
+def _as_bools(values):
+    # bytes holding 0 or 1 per cell, from bytes, a bytearray, a list or a NumPy array.
+    if numpy_available and isinstance(values, numpy.ndarray):
+        values = numpy.ascontiguousarray(values, dtype=numpy.uint8).tobytes()
+    return bytes(values).translate(_TO_BOOL)
+
+def map_buffers_supported():
+    return bool(_map_get_layout())
+
+def map_set_buffers(m, transparent, walkable):
+    # Set every cell's properties at once, from two sequences of one value per cell, row by row.
+    transparent = _as_bools(transparent)
+    walkable = _as_bools(walkable)
+    layout = _map_get_layout()
+    if not layout:
+        width = map_get_width(m)
+        for i in range(len(transparent)):
+            map_set_properties(m, i % width, i // width, transparent[i], walkable[i])
+        return
+    cmap = _map_cells(m)
+    n = cmap.nbcells
+    if len(transparent) != n or len(walkable) != n:
+        raise ValueError('map_set_buffers needs one value per cell')
+    if layout == 'bits':
+        data = (int.from_bytes(transparent, 'little') | (int.from_bytes(walkable, 'little') << 1)).to_bytes(n, 'little')
+    else:
+        data = bytearray(3 * n)
+        data[0::3] = transparent
+        data[1::3] = walkable
+        data = bytes(data)
+    memmove(cmap.cells, data, len(data))
+
+def map_patch_cells(m, cells, transparent, walkable):
+    # Update only the given cells (indexes, row by row) from full sequences of one value per cell.
+    layout = _map_get_layout()
+    if not layout:
+        width = map_get_width(m)
+        for i in cells:
+            map_set_properties(m, i % width, i // width, bool(transparent[i]), bool(walkable[i]))
+        return
+    cmap = _map_cells(m)
+    if layout == 'bits':
+        raw = (c_ubyte * cmap.nbcells).from_address(cmap.cells)
+        for i in cells:
+            raw[i] = (raw[i] & 4) | (1 if transparent[i] else 0) | (2 if walkable[i] else 0)
+    else:
+        raw = (c_ubyte * (3 * cmap.nbcells)).from_address(cmap.cells)
+        for i in cells:
+            raw[3 * i] = 1 if transparent[i] else 0
+            raw[3 * i + 1] = 1 if walkable[i] else 0
+
+def map_get_fov_buffer(m):
+    # bytes holding 1 for each cell in the last computed field of view and 0 elsewhere, row by row.
+    layout = _map_get_layout()
+    if not layout:
+        width = map_get_width(m)
+        height = map_get_height(m)
+        return bytes(1 if map_is_in_fov(m, x, y) else 0 for y in range(height) for x in range(width))
+    cmap = _map_cells(m)
+    if layout == 'bits':
+        return string_at(cmap.cells, cmap.nbcells).translate(_FOV_BIT)
+    return string_at(cmap.cells, 3 * cmap.nbcells)[2::3]
+
+def map_get_fov_window(m, x0, y0, w, h):
+    # Like map_get_fov_buffer, for the w x h rectangle at (x0, y0) only: each of its rows is read from its own
+    # offset in the map's cells, so nothing outside the rectangle is copied.
+    layout = _map_get_layout()
+    if not layout:
+        return bytes(1 if map_is_in_fov(m, x, y) else 0 for y in range(y0, y0 + h) for x in range(x0, x0 + w))
+    cmap = _map_cells(m)
+    size = 1 if layout == 'bits' else 3
+    data = b''.join(string_at(cmap.cells + size * (y * cmap.width + x0), size * w) for y in range(y0, y0 + h))
+    if layout == 'bits':
+        return data.translate(_FOV_BIT)
+    return data[2::3]
+
 def map_get_width(map):
     return _lib.TCOD_map_get_width(map)
 
@@ -1,7 +1,24 @@
 import libtcodpy as libtcod
+import array
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import json
 import math
-import shelve
+import mmap
+import multiprocessing
+import os
+import queue
+import savefile
+import sys
+import tempfile
 import textwrap
+import threading
+import time
+import zlib
 
 #############################################
 # Constants and Big Vars
@@ -10,6 +27,11 @@ import textwrap
 # Testing State
 TESTING = True
 
+# Headless State: no window and nothing is drawn (see init_console).
+headless = False
+# Scripted games take their input from a ScriptedInput instead of the keyboard and mouse.
+input_script = None
+
 # Size of the window
 SCREEN_WIDTH = 100
 SCREEN_HEIGHT = 70
@@ -32,6 +54,7 @@ CHARACTER_SCREEN_WIDTH = 30
 ROOM_MAX_SIZE = 13
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 200
+MONSTER_DENSITY = 1.0  # Multiplier on the maximum number of monsters per room.
 
 # Inventory
 INVENTORY_WIDTH = 50
@@ -52,48 +75,119 @@ LIGHTNING_RANGE = 5
 # Field of Vision
 FOV_ALGO = 0
 FOV_LIGHT_WALLS = True
+MONSTER_SIGHT_RADIUS = 8
+VISIBILITY_CACHE_SIZE = 512  # Number of fields of view the VisibilityService keeps.
+
+# Monster movement (see PathService)
+PATH_RECOMPUTE_DISTANCE = 2  # How far the target may move before a monster's path to it is recomputed.
+PATH_MAX_LENGTH = 25  # Longer paths aren't followed; the monster just heads straight for the target.
+
+# AI scheduling (see Scheduler)
+AI_REGION_SIZE = 16  # Dormant monsters are filed by square regions of this many cells a side.
+AI_WAKE_MARGIN = 4  # Dormant monsters wake within sight range plus this many cells of the player...
+AI_SLEEP_MARGIN = 8  # ...and go back to sleep once this many cells further away.
+AI_NOISE_RADIUS = 15  # How far the noise of a fight or an explosion wakes monsters.
 
 LIMIT_FPS = 20  # 20 frames-per-second maximum
 
+# Saving (see savefile.py for the format)
+SAVE_FILE = 'savegame.sav'
+JOURNAL_FILE = SAVE_FILE + '.journal'
+AUTOSAVE = True  # Keep the save current while playing, through the journal.
+AUTOSAVE_COMPACT_TURNS = 100  # Turns between full saves; in between, only each turn's changes are written.
+LEVEL_FILE = SAVE_FILE + '.levels'  # The levels the player has left (see LevelArchive).
+LEVEL_CACHE_SIZE = 3  # Levels kept decoded in memory.
+PREGENERATE_LEVELS = 2  # Levels below the current one generated ahead of time in worker processes (see LevelPool).
+# Functions that saved objects may refer to by name (death and use functions).
+SAVED_FUNCTIONS = ['cast_confuse', 'cast_fireball', 'cast_heal', 'cast_lightning', 'monster_death', 'player_death']
+
+# Profiling: time the stages of each frame, show them on the panel and save them on exit (rl.py --profile).
+PROFILING = False
+PROFILE_WINDOW = 100  # Number of recent frames the panel's averages cover.
+PROFILE_JSON = 'profile.json'
+PROFILE_CSV = 'profile.csv'
+
+# What place_objects puts in rooms. Values that change with the dungeon level are tables of
+# [[value, from level], ...] (see from_dungeon_level). The monsters and items themselves, with the chance of
+# each, are in ENTITY_FILE (see Template).
+MAX_ROOM_MONSTERS = [[2, 1], [3, 4], [5, 6]]
+MAX_ROOM_ITEMS = [[1, 1], [2, 4]]
+ENTITY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'entities.json')
 # Colors of Terrain
 color_dark_wall = libtcod.Color(0, 0, 100)
 color_light_wall = libtcod.Color(130, 110, 50)
 color_dark_ground = libtcod.Color(50, 50, 150)
 color_light_ground = libtcod.Color(200, 180, 50)
 
+# Translation table turning 0 into 1 and 1 into 0.
+INVERT = bytes([1]) + bytes(255)
+
+# Background color of a map cell, looked up by explored + 2 * visible + 4 * wall (see fill_map_background).
+cell_colors = [libtcod.black, color_dark_ground, color_light_ground, color_light_ground,
+  libtcod.black, color_dark_wall, color_light_wall, color_light_wall]
+
 # Python 3 Global Vars
-map = []
+map = None
 objects = []
 game_msgs = []
+occupancy = None
 stairs = None
+upstairs = None
 dungeon_level = 1
+# Random numbers come from named streams, each seeded from the game's master seed (see seed_stream), so a game
+# can be replayed from its seed and a level can be generated anywhere. 'mapgen' (the map) and 'spawn' (monsters
+# and items) are reseeded for each level; 'combat' and 'ai' run through the whole game.
+GAME_SEED = None  # Set (or pass --seed) to play the same games every time.
+game_seed = 0
+rng = {}
+spawn_cache = {}  # Compiled spawn tables, by (dungeon level, monster density); see spawn_tables.
+templates = None  # Monster and item templates from ENTITY_FILE: {'monsters': [...], 'items': [...]}.
 
 torch_bonus = 0
 
+color_tables = None
+
+# Incremental rendering: map cells (flat indices) that must be redrawn on 'con', and whether everything must be.
+dirty_cells = set()
+redraw_all = True
+message_serial = 0  # Bumped by message(), so the panel knows when to redraw.
+panel_key = None
+# Frame-cost counters: 'cost' is the number of console operations a frame needed; idle frames cost 0.
+render_stats = {'frames': 0, 'idle_frames': 0, 'cost': 0, 'last_cost': 0}
+
 #############################################
 # Classes
 #############################################
 
 class AI_BasicMonster:
   # AI for a Basic Monster
+  __slots__ = ('owner',)
+  can_sleep = True  # It does nothing out of the player's sight, so the Scheduler may let it sleep.
+
   def __init__(self, owner):
     self.owner = owner
     owner.ai = self
 
   def take_turn(self):
-    # A basic monster takes its turn. If you can see it, it can see you.
+    # A basic monster takes its turn, chasing the player if it can see them from where it stands.
     monster = self.owner
-    if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+    if (monster.distance_to(player) <= MONSTER_SIGHT_RADIUS and
+        visibility.can_see(monster.x, monster.y, player.x, player.y)):
       # Move towards player if non-adjacent.
       if monster.distance_to(player) >= 2:
-        monster.move_towards(player.x, player.y)
+        # Downhill on the shared distance map; if other monsters are in the way, along its own path.
+        if not flow.step(monster):
+          paths.step(monster, player.x, player.y)
       # Adjacent? Attack if the player is still alive.
       elif player.fighter.hp > 0:
         monster.fighter.attack(player)
 
 class AI_ConfusedMonster:
   # AI for a temporarily Confused Monster
-  def __init__(self, old_ai, num_turns = CONFUSE_NUM_TURNS):
+  __slots__ = ('owner', 'old_ai', 'num_turns')
+  can_sleep = False
+
+  def __init__(self, owner, old_ai, num_turns = CONFUSE_NUM_TURNS):
     self.owner = owner
     self.old_ai = old_ai
     self.num_turns = num_turns
@@ -102,14 +196,169 @@ class AI_ConfusedMonster:
   def take_turn(self):
     if self.num_turns > 0: # Monster still confused
       # Move in a random direction, and decrease num_turns confused.
-      self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+      self.owner.move(libtcod.random_get_int(rng['ai'], -1, 1), libtcod.random_get_int(rng['ai'], -1, 1))
       self.num_turns -= 1
+      autosave.touch(self.owner)
     else: # Restore the previous AI and destroy this one.
       self.owner.ai = self.old_ai
       message('The ' + self.owner.name + ' is no longer confused!')
 
+class Autosave:
+  # Keeps the save file current while playing. After each turn only what changed (a delta: tiles, objects that
+  # moved, changed or died, the inventory, new messages) is appended to the journal. Every AUTOSAVE_COMPACT_TURNS
+  # turns, and on every new level, the game is saved in full and the journal starts over. load_game replays the
+  # journal on top of the save. The save thread (see SaveWorker) owns the journal and does all the writing; this
+  # only works out the deltas. What changed is recorded where it changes (touch, touch_cells, reorder), so a
+  # turn's delta costs only as much as the turn did, however big the level.
+  def __init__(self):
+    self.active = False  # Whether the game is being journaled.
+    self.objects = set()  # Objects changed since the last delta.
+    self.cells = set()  # Indices of the tiles changed since the last delta.
+    self.reordered = False  # Whether gameobjects or the inventory changed order or membership.
+
+  def compact(self):
+    # Save the whole game and start a new, empty journal for it.
+    snapshot = save_game(announce = False, journal = True)
+    self.active = True
+    # Remember what was saved, to compare the following turns against.
+    self.grid = map
+    self.flags = bytearray(snapshot['grid'][2])
+    self.slots = dict((obj, slot) for (slot, obj) in enumerate(gameobjects + inventory))
+    self.next_slot = len(self.slots)
+    self.records = dict(enumerate(snapshot['objects']))
+    self.map_order = list(range(len(gameobjects)))
+    self.inventory_order = list(range(len(gameobjects), len(gameobjects) + len(inventory)))
+    self.message_serial = message_serial
+    self.objects.clear()
+    self.cells.clear()
+    self.reordered = False
+    self.turns = 0
+
+  def delta(self):
+    # What changed since the last turn recorded, as a journal delta.
+    delta = {'dungeon_level': dungeon_level, 'game_state': game_state}
+    tiles = []
+    for i in sorted(self.cells):
+      cell = map.blocked[i] | map.block_sight[i] << 1 | map.explored[i] << 2
+      if cell != self.flags[i]:
+        self.flags[i] = cell
+        tiles.append((i, cell))
+    delta['tiles'] = tiles
+    self.cells.clear()
+    # Objects that are new or changed, and those that are gone.
+    slots = []
+    records = []
+    removed = []
+    for obj in self.objects:
+      slot = self.slots.get(obj)
+      if not obj.placed and obj not in inventory:
+        if slot is not None:
+          removed.append(slot)
+          del self.slots[obj]
+          del self.records[slot]
+        continue
+      if slot is None:
+        slot = self.slots[obj] = self.next_slot
+        self.next_slot += 1
+      record = object_record(obj)
+      if self.records.get(slot) != record:
+        self.records[slot] = record
+        slots.append(slot)
+        records.append(record)
+    self.objects.clear()
+    delta['slots'] = slots
+    delta['objects'] = records
+    delta['removed'] = removed
+    delta['player'] = self.slots[player]
+    delta['stairs'] = self.slots[stairs]
+    delta['upstairs'] = self.slots[upstairs] if upstairs else -1
+    if self.reordered:
+      map_order = [self.slots[obj] for obj in gameobjects]
+      if map_order != self.map_order:
+        delta['map_order'] = self.map_order = map_order
+      inventory_order = [self.slots[obj] for obj in inventory]
+      if inventory_order != self.inventory_order:
+        delta['inventory_order'] = self.inventory_order = inventory_order
+      self.reordered = False
+    if message_serial != self.message_serial:
+      delta['messages'] = [(line, tuple(color)) for (line, color) in game_msgs]
+      self.message_serial = message_serial
+    return delta
+
+  def record_turn(self):
+    # Write this turn's changes, or the whole game if it's time to compact or the level changed.
+    if not self.active:
+      return
+    if map is not self.grid or self.turns >= AUTOSAVE_COMPACT_TURNS:
+      self.compact()
+      return
+    saver.append(self.delta())
+    self.turns += 1
+
+  def reorder(self, obj):
+    # Note that obj joined or left gameobjects or the inventory, or moved within them.
+    if self.active:
+      self.objects.add(obj)
+      self.reordered = True
+
+  def stop(self):
+    # Stop journaling. The journal is left on disk, to be replayed by load_game if the game wasn't saved in full.
+    if self.active:
+      saver.close_journal()
+      self.active = False
+
+  def touch(self, obj):
+    # Note that something saved about obj changed.
+    if self.active:
+      self.objects.add(obj)
+
+  def touch_cells(self, cells):
+    # Note that the tiles at these indices may have changed.
+    if self.active:
+      self.cells.update(cells)
+
+class ComponentStore:
+  # The components of one kind (fighter, AI, status effect) of the objects on the map, packed in a list, so the
+  # systems that use them (the turn loop, targeting) go through just those instead of every object. 'owners'
+  # lists the object of each component. Removing one moves the last into its place.
+  def __init__(self):
+    self.components = []
+    self.owners = []
+    self.positions = {}
+
+  def clear(self):
+    self.components = []
+    self.owners = []
+    self.positions = {}
+
+  def discard(self, owner):
+    i = self.positions.pop(owner, None)
+    if i is None:
+      return
+    last_component = self.components.pop()
+    last_owner = self.owners.pop()
+    if last_owner is not owner:
+      self.components[i] = last_component
+      self.owners[i] = last_owner
+      self.positions[last_owner] = i
+
+  def set(self, owner, component):
+    # Store the owner's component, replacing the one it had; None removes it.
+    if component is None:
+      self.discard(owner)
+      return
+    i = self.positions.get(owner)
+    if i is None:
+      self.positions[owner] = len(self.components)
+      self.components.append(component)
+      self.owners.append(owner)
+    else:
+      self.components[i] = component
+
 class Equipment:
   # An object that can be equipped, yielding bonuses. Automatically adds the Item component.
+  __slots__ = ('owner', 'slot', 'is_equipped', 'power_bonus', 'defense_bonus', 'max_hp_bonus', 'torch_bonus', 'dodge_bonus')
+
   def __init__(self, owner, slot, power_bonus = 0, defense_bonus = 0, max_hp_bonus = 0, torch_bonus = 0, dodge_bonus = 0):
     self.power_bonus = power_bonus
     self.defense_bonus = defense_bonus
@@ -140,22 +389,56 @@ class Equipment:
       old_equipment.dequip()
     # Equip object and show a message about it.
     self.is_equipped = True
+    player.equipment_stats.add(self)
+    autosave.touch(self.owner)
     message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
     fov_recompute = True
 
   def dequip(self):
     # Dequip object and show a message about it.
+    global fov_recompute
     if not self.is_equipped:
       return
     self.is_equipped = False
+    player.equipment_stats.remove(self)
+    autosave.touch(self.owner)
     message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
     fov_recompute = True
 
   def check_equip(self):
     return self.is_equipped
 
+class EquipmentStats:
+  # Running totals of the bonuses of everything its owner has equipped, so stat reads don't rescan the inventory.
+  # Kept up to date by Equipment.equip and dequip.
+  def __init__(self):
+    self.power = 0
+    self.defense = 0
+    self.dodge = 0
+    self.max_hp = 0
+    self.torch = 0
+    self.slots = {}  # The equipment in each used slot.
+
+  def add(self, equipment):
+    self.slots[equipment.slot] = equipment
+    self.apply(equipment, 1)
+
+  def apply(self, equipment, sign):
+    self.power += sign * equipment.power_bonus
+    self.defense += sign * equipment.defense_bonus
+    self.dodge += sign * equipment.dodge_bonus
+    self.max_hp += sign * equipment.max_hp_bonus
+    self.torch += sign * equipment.torch_bonus
+
+  def remove(self, equipment):
+    if self.slots.get(equipment.slot) is equipment:
+      del self.slots[equipment.slot]
+    self.apply(equipment, -1)
+
 class Fighter:
   # A composite class for combat-related properties.
+  __slots__ = ('owner', 'base_max_hp', 'hp', 'base_defense', 'base_power', 'base_dodge', 'xp', 'to_hit', 'death_function')
+
   def __init__(self, owner, hp, defense, power, xp, death_function = None, to_hit = 80, dodge = 0):
     self.owner = owner
     self.owner.fighter = self
@@ -171,29 +454,30 @@ class Fighter:
   @property
   def power(self):
     # Returns dynamic power value.
-    bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_power + bonus
+    stats = self.owner.equipment_stats
+    return self.base_power + (stats.power if stats else 0)
 
   @property
   def defense(self):
     # Returns dynamic defense value.
-    bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_defense + bonus
+    stats = self.owner.equipment_stats
+    return self.base_defense + (stats.defense if stats else 0)
 
   @property
   def dodge(self):
     # Returns dynamic dodge value.
-    bonus = sum(equipment.dodge_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_dodge + bonus
+    stats = self.owner.equipment_stats
+    return self.base_dodge + (stats.dodge if stats else 0)
 
   @property
   def max_hp(self):
     # Returns dynamic max_hp value.
-    bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-    return self.base_max_hp + bonus
+    stats = self.owner.equipment_stats
+    return self.base_max_hp + (stats.max_hp if stats else 0)
 
   def attack(self, target):
-    chance_hit = libtcod.random_get_int(0, 1, 101)
+    scheduler.noise(self.owner.x, self.owner.y)
+    chance_hit = libtcod.random_get_int(rng['combat'], 1, 101)
     if self.to_hit < (chance_hit + target.fighter.dodge):
       message(self.owner.name.capitalize() + ' swings and misses!')
       return
@@ -211,11 +495,13 @@ class Fighter:
     self.hp += amount
     if self.hp > self.max_hp:
       self.hp = self.max_hp
+    autosave.touch(self.owner)
 
   def take_damage(self, damage):
     # Apply damage if possible.
     if damage > 0:
       self.hp -= damage
+      autosave.touch(self.owner)
       # Check for death. If there's a death function, call it.
       if self.hp <= 0:
         function = self.death_function
@@ -223,19 +509,77 @@ class Fighter:
           function(self.owner)
         if self.owner != player: # Yield experience to the player
           player.fighter.xp += self.xp
+          autosave.touch(player)
+
+class FlowField:
+  # Distances to the player over the whole map, computed once (with libtcod's Dijkstra) and shared by every
+  # chasing monster, which only has to step to whichever neighbour is closest to the player. The distances are
+  # recomputed only when the player has moved or the map has changed.
+  NEIGHBOURS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+  def __init__(self):
+    self.fov = None
+    self.handle = None
+    self.origin = None  # (x, y, map version) the distances were computed for.
+    self.computes = 0
+
+  def distance(self, x, y):
+    # Distance from (x, y) to the player along the floor, or -1 if it can't be reached.
+    return libtcod.dijkstra_get_distance(self.handle, x, y)
+
+  def reset(self):
+    # Forget the distances, e.g. when a new map is made.
+    if self.handle is not None:
+      libtcod.dijkstra_delete(self.handle)
+    self.fov = fov_map
+    self.handle = libtcod.dijkstra_new(fov_map)
+    self.origin = None
+
+  def step(self, monster):
+    # Move the monster to a free neighbouring cell closer to the player. Returns False if there is none.
+    self.update()
+    best = self.distance(monster.x, monster.y)
+    if best < 0:
+      return False
+    move = None
+    for (dx, dy) in self.NEIGHBOURS:
+      x, y = monster.x + dx, monster.y + dy
+      if 0 <= x < map.width and 0 <= y < map.height:
+        distance = self.distance(x, y)
+        if 0 <= distance < best and not is_blocked(x, y):
+          best = distance
+          move = (dx, dy)
+    if move is None:
+      return False
+    monster.move(*move)
+    return True
+
+  def update(self):
+    # Recompute the distances if the player has moved or the map has changed since they were computed.
+    if self.fov is not fov_map:
+      self.reset()
+    sync_fov()
+    origin = (player.x, player.y, map.version)
+    if origin != self.origin:
+      self.computes += 1
+      libtcod.dijkstra_compute(self.handle, player.x, player.y)
+      self.origin = origin
 
 class Item:
 # An item that can be picked up and used.
+  __slots__ = ('owner', 'use_function')
+
   def __init__(self, owner, use_function = None):
     self.use_function = use_function
     self.owner = owner
     owner.item = self
   def drop(self):
     # Add item to the map @ player's coordinates, and remove from the player's inventory.
-    gameobjects.append(self.owner)
     inventory.remove(self.owner)
+    autosave.reorder(self.owner)
     self.owner.x = player.x
     self.owner.y = player.y
+    add_object(self.owner)
     message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
     # Special Case: If the object has the Equipment component, dequip it before dropping.
     if self.owner.equipment:
@@ -247,7 +591,8 @@ class Item:
       message('Your inventory is full, cannot pick up ' + self.owner.name + '.', libtcod.red)
     else:
       inventory.append(self.owner)
-      gameobjects.remove(self.owner)
+      autosave.reorder(self.owner)
+      remove_object(self.owner)
       message('You picked up a ' + self.owner.name + '!', libtcod.green)
     # Special Case: Automatically equip, if the corresponding equipment slot is unused.
     equipment = self.owner.equipment
@@ -266,6 +611,165 @@ class Item:
       if self.use_function() != 'cancelled':
         # Destroy after use, unless it was cancelled for some reason.
         inventory.remove(self.owner)
+        autosave.reorder(self.owner)
+
+class LevelArchive:
+  # The levels the player has left, so they can be revisited without keeping them all in memory. Each level is
+  # appended to the archive file when the player leaves it, and read back through a memory map of the file when
+  # the player returns. The last few levels read or written stay decoded in memory, least recently used first out.
+  # Records are numbered (see savefile.py), so opening the archive for a save drops those written after it.
+  def __init__(self):
+    self.path = None
+    self.file = None
+    self.data = None
+    self.index = {}
+    self.serial = 0  # Serial number of the next record.
+    self.cache = collections.OrderedDict()
+
+  def close(self):
+    if self.data is not None:
+      self.data.close()
+      self.data = None
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+    self.index = {}
+    self.serial = 0
+    self.cache.clear()
+
+  def compact(self):
+    # Rewrite the archive with only the last record of each level, if the older ones take up most of it.
+    live = sum(length + savefile.LEVEL.size for (offset, length) in self.index.values())
+    if self.data is None or len(self.data) <= 2 * live:
+      return
+    with open(self.path + '.tmp', 'wb') as f:
+      savefile.copy_levels(self.data, self.index, f)
+      f.flush()
+      os.fsync(f.fileno())
+    self.data.close()
+    self.data = None
+    self.file.close()
+    os.replace(self.path + '.tmp', self.path)
+    self.file = open(self.path, 'r+b')
+    self.map_file()
+    self.index = savefile.scan_levels(self.data)[0]
+
+  def get(self, level):
+    # Returns the level record (see level_record) of a level the player has left, or None.
+    record = self.cache.get(level)
+    if record is not None:
+      self.cache.move_to_end(level)
+      return record
+    if level not in self.index:
+      return None
+    (offset, length) = self.index[level]
+    record = savefile.loads(self.data[offset:offset + length])
+    self.remember(level, record)
+    return record
+
+  def map_file(self):
+    # (Re)map the whole file; a memory map doesn't grow with the file.
+    if self.data is not None:
+      self.data.close()
+      self.data = None
+    self.file.flush()
+    if os.fstat(self.file.fileno()).st_size > 0:
+      self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+
+  def open(self, path, new = False, serial = None):
+    # Open the archive of a saved game, or start an empty one for a new game. The file is created when the
+    # first level is put in it. 'serial' is the save's number of records (its 'levels'); later ones are cut off.
+    # With no path, the archive is a temporary file, for games that are never saved.
+    self.close()
+    self.path = path
+    if path is None:
+      return
+    if new and os.path.exists(path):
+      os.remove(path)
+    if os.path.exists(path):
+      self.file = open(path, 'r+b')
+      self.map_file()
+      if self.data is not None:
+        (self.index, end, self.serial) = savefile.scan_levels(self.data, serial)
+        if end < len(self.data):
+          self.data.close()
+          self.data = None
+          self.file.truncate(end)
+          self.map_file()
+        self.compact()
+
+  def put(self, level, record):
+    # Store a level the player is leaving.
+    if self.file is None:
+      self.file = open(self.path, 'w+b') if self.path is not None else tempfile.TemporaryFile()
+    self.index[level] = savefile.append_level(self.file, level, self.serial, record)
+    self.serial += 1
+    self.map_file()
+    self.remember(level, record)
+
+  def remember(self, level, record):
+    self.cache[level] = record
+    self.cache.move_to_end(level)
+    while len(self.cache) > LEVEL_CACHE_SIZE:
+      self.cache.popitem(last = False)
+
+class LevelPool:
+  # Generates the next few levels in worker processes while the player explores, so that taking the stairs
+  # down only swaps in a ready level. A level is generated from its own streams (see seed_stream), so a worker
+  # makes exactly the level make_map would. If worker processes can't be started, levels are made on the spot.
+  # Workers are spawned rather than forked, as forking a process with a window and the save thread running can
+  # leave the child stuck on a lock; a spawned worker starts from a fresh import, so it is given the settings.
+  SETTINGS = ['MAP_WIDTH', 'MAP_HEIGHT', 'MAX_ROOMS', 'ROOM_MIN_SIZE', 'ROOM_MAX_SIZE', 'MONSTER_DENSITY']
+
+  def __init__(self):
+    self.executor = None
+    self.futures = {}
+    self.seed = None
+    self.failed = False
+
+  def prefetch(self, level):
+    # Start generating the levels below 'level' that haven't been made yet.
+    if self.failed or PREGENERATE_LEVELS <= 0:
+      return
+    if self.seed != game_seed:
+      self.reset()
+      self.seed = game_seed
+    for upcoming in range(level + 1, level + 1 + PREGENERATE_LEVELS):
+      if upcoming in self.futures or upcoming in levels.index:
+        continue
+      try:
+        if self.executor is None:
+          self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = PREGENERATE_LEVELS,
+            mp_context = multiprocessing.get_context('spawn'))
+        settings = dict((name, globals()[name]) for name in self.SETTINGS)
+        self.futures[upcoming] = self.executor.submit(generate_level, game_seed, upcoming, settings)
+      except (OSError, NotImplementedError, RuntimeError):
+        self.failed = True
+        return
+
+  def reset(self):
+    # Forget levels generated for another game.
+    for future in self.futures.values():
+      future.cancel()
+    self.futures = {}
+
+  def shutdown(self):
+    # Cancel the levels in the works and let the worker processes go.
+    self.reset()
+    if self.executor is not None:
+      self.executor.shutdown(wait = False)
+      self.executor = None
+
+  def take(self, level):
+    # Returns the level record of a generated level, waiting for it if it's still being made, or None if it
+    # wasn't asked for (or its worker failed).
+    future = self.futures.pop(level, None)
+    if future is None or self.seed != game_seed:
+      return None
+    try:
+      return savefile.loads(future.result())
+    except Exception:
+      return None
 
 class Light:
   def __init__(self):
@@ -273,12 +777,15 @@ class Light:
   @property
   def TORCH_RADIUS(self):
     # Returns dynamic light value. Only works for items equipped by player.
-    torch_bonus = sum(equipment.torch_bonus for equipment in get_all_equipped(player))
-    return self.base_light_radius + torch_bonus
+    return self.base_light_radius + player.equipment_stats.torch
 
 class GameObject:
   # This object is a generic item in game: player, monster, item, tile feature
   # An object is always represented as a symbol on screen.
+  # Game objects and their components have __slots__ rather than a __dict__ each, as levels hold hundreds.
+  __slots__ = ('x', 'y', 'char', 'name', 'color', 'blocks', 'always_visible', 'level', 'placed',
+    '_fighter', '_ai', '_status_effect', 'item', 'equipment', 'equipment_stats')
+
   def __init__(self, x, y, char, name, color, blocks = False, always_visible = False):
     self.x = x
     self.y = y
@@ -287,13 +794,60 @@ class GameObject:
     self.color = color
     self.blocks = blocks
     self.always_visible = always_visible
-
-    # Components which may be created later, but must exist to be tested.
-    self.fighter = None
-    self.ai = None
-    self.status_effect = None
+    self.level = 0  # Experience level, for the player.
+
+    # Components which may be created later, but must exist to be tested. While the object is on the map
+    # ('placed'), its fighter, AI and status effect are also kept in the component stores.
+    self.placed = False
+    self._fighter = None
+    self._ai = None
+    self._status_effect = None
     self.item = None
     self.equipment = None
+    # Bonuses from equipped items, for objects that can equip things (the player).
+    self.equipment_stats = None
+
+  @property
+  def ai(self):
+    return self._ai
+
+  @ai.setter
+  def ai(self, ai):
+    self._ai = ai
+    autosave.touch(self)
+    if self.placed:
+      stores['ai'].set(self, ai)
+
+  @property
+  def fighter(self):
+    return self._fighter
+
+  @fighter.setter
+  def fighter(self, fighter):
+    self._fighter = fighter
+    autosave.touch(self)
+    if self.placed:
+      stores['fighter'].set(self, fighter)
+
+  @property
+  def status_effect(self):
+    return self._status_effect
+
+  @status_effect.setter
+  def status_effect(self, status_effect):
+    self._status_effect = status_effect
+    autosave.touch(self)
+    if self.placed:
+      stores['status_effect'].set(self, status_effect)
+
+  def place(self, placed):
+    # Put the object's components in the stores when it goes on the map, or take them out when it leaves.
+    self.placed = placed
+    for (name, store) in stores.items():
+      if placed:
+        store.set(self, getattr(self, name))
+      else:
+        store.discard(self)
 
   def clear(self):
     # Erase the character that represents this object.
@@ -311,7 +865,8 @@ class GameObject:
 
   def draw(self):
     # Check to see if the object is in the player's FOV
-    if libtcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map[self.x][self.y].explored):
+    i = map.index(self.x, self.y)
+    if map.visible[i] or (self.always_visible and map.explored[i]):
       # Set the color and then draw the corresponding character of the object in that color.
       libtcod.console_set_default_foreground(con, self.color)
       libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
@@ -320,8 +875,13 @@ class GameObject:
     # Move object by the param amount.
     global map
     if not is_blocked(self.x + dx, self.y + dy):
+      old_x, old_y = self.x, self.y
       self.x += dx
       self.y += dy
+      occupancy.move(self, old_x, old_y)
+      autosave.touch(self)
+      mark_dirty(old_x, old_y)
+      mark_dirty(self.x, self.y)
 
   def move_towards(self, target_x, target_y):
     # Generate vector from this object to the target, and distance.
@@ -338,9 +898,193 @@ class GameObject:
     global gameobjects
     gameobjects.remove(self)
     gameobjects.insert(0, self)
+    autosave.reorder(self)
+    occupancy.send_to_back(self)
+    mark_dirty(self.x, self.y)
+
+class OccupancyGrid:
+  # Index of the gameobjects on the map by cell, so position queries don't scan the whole gameobjects list.
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    # Objects on each cell (by flat index, as in TileGrid), in drawing order.
+    self.cells = {}
+    # Number of blocking objects on each cell; 16 bits, as a big pack can stack more than 255 on one cell.
+    self.blockers = array.array('H', [0]) * (width * height)
+
+  def add(self, obj):
+    i = obj.y * self.width + obj.x
+    self.cells.setdefault(i, []).append(obj)
+    if obj.blocks:
+      self.blockers[i] += 1
+
+  def at(self, x, y):
+    # Returns the objects on (x, y). The list belongs to the index and must not be modified.
+    if 0 <= x < self.width and 0 <= y < self.height:
+      return self.cells.get(y * self.width + x, [])
+    return []
+
+  def is_blocked(self, x, y):
+    return self.blockers[y * self.width + x] > 0
+
+  def move(self, obj, old_x, old_y):
+    # Re-file an object after its coordinates changed from (old_x, old_y).
+    i = old_y * self.width + old_x
+    self.cells[i].remove(obj)
+    if not self.cells[i]:
+      del self.cells[i]
+    if obj.blocks:
+      self.blockers[i] -= 1
+    self.add(obj)
+
+  def remove(self, obj):
+    i = obj.y * self.width + obj.x
+    self.cells[i].remove(obj)
+    if not self.cells[i]:
+      del self.cells[i]
+    if obj.blocks:
+      self.blockers[i] -= 1
+
+  def send_to_back(self, obj):
+    objects_here = self.cells[obj.y * self.width + obj.x]
+    objects_here.remove(obj)
+    objects_here.insert(0, obj)
+
+  def set_blocks(self, obj, blocks):
+    # Change whether an object blocks, keeping the blocker counts right.
+    if obj.blocks != blocks:
+      self.blockers[obj.y * self.width + obj.x] += 1 if blocks else -1
+      obj.blocks = blocks
+
+class PathService:
+  # A* paths for monsters chasing a target. Each monster keeps its path handle and follows the path it has, which
+  # is recomputed only when the target has moved more than PATH_RECOMPUTE_DISTANCE from where it was, the map has
+  # changed, or the monster is no longer where the path left it. 'hits' counts the turns a kept path was followed,
+  # 'misses' the turns it had to be computed.
+  def __init__(self):
+    self.fov = None
+    self.paths = {}  # Monster -> [path handle, target x, target y, map version].
+    self.hits = 0
+    self.misses = 0
+
+  def forget(self, monster):
+    # Drop a monster's path, e.g. when it dies.
+    entry = self.paths.pop(monster, None)
+    if entry is not None:
+      libtcod.path_delete(entry[0])
+
+  def path(self, monster, target_x, target_y):
+    # Returns the monster's path handle, with a path to (target_x, target_y) from where it stands.
+    entry = self.paths.get(monster)
+    if entry is None:
+      entry = [libtcod.path_new_using_map(fov_map), None, None, None]
+      self.paths[monster] = entry
+    (handle, x, y, version) = entry
+    if (x is None or version != map.version or max(abs(target_x - x), abs(target_y - y)) > PATH_RECOMPUTE_DISTANCE
+        or libtcod.path_is_empty(handle) or libtcod.path_get_origin(handle) != (monster.x, monster.y)):
+      self.misses += 1
+      libtcod.path_compute(handle, monster.x, monster.y, target_x, target_y)
+      entry[1:] = [target_x, target_y, map.version]
+    else:
+      self.hits += 1
+    return handle
+
+  def reset(self):
+    # Forget every path, e.g. when a new map is made.
+    for entry in self.paths.values():
+      libtcod.path_delete(entry[0])
+    self.paths.clear()
+    self.fov = fov_map
+
+  def step(self, monster, target_x, target_y):
+    # Move the monster one step along its path to the target. If there is no usable path, or the next cell is
+    # blocked (by another monster, say), it heads straight for the target instead.
+    if self.fov is not fov_map:
+      self.reset()
+    sync_fov()
+    handle = self.path(monster, target_x, target_y)
+    if not libtcod.path_is_empty(handle) and libtcod.path_size(handle) <= PATH_MAX_LENGTH:
+      (x, y) = libtcod.path_get(handle, 0)
+      if not is_blocked(x, y):
+        monster.move(x - monster.x, y - monster.y)
+        libtcod.path_walk(handle, False)
+        return
+    monster.move_towards(target_x, target_y)
+
+class Profiler:
+  # Opt-in timers for the stages of a frame. For each stage it keeps the number of calls, total and maximum time,
+  # the times of the last PROFILE_WINDOW calls, and a histogram of those recent times.
+  BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100]  # Upper bounds of the histogram buckets, in ms.
+
+  def __init__(self):
+    self.enabled = False
+    self.stages = {}
+
+  def dump(self, json_path = PROFILE_JSON, csv_path = PROFILE_CSV):
+    # Save the summary as JSON and as CSV (one row per stage).
+    summary = self.summary()
+    with open(json_path, 'w') as f:
+      json.dump(summary, f, indent = 2)
+    with open(csv_path, 'w', newline = '') as f:
+      writer = csv.writer(f)
+      buckets = ['<=' + str(bound) + 'ms' for bound in self.BUCKETS] + ['>' + str(self.BUCKETS[-1]) + 'ms']
+      writer.writerow(['stage', 'calls', 'total_ms', 'mean_ms', 'max_ms', 'recent_mean_ms'] + buckets)
+      for (name, stage) in summary.items():
+        writer.writerow([name, stage['calls'], stage['total_ms'], stage['mean_ms'], stage['max_ms'], stage['recent_mean_ms']] + stage['histogram'])
+
+  def enable(self):
+    # Start profiling, and save the results when the program exits.
+    if not self.enabled:
+      self.enabled = True
+      atexit.register(self.dump)
+
+  def overlay_lines(self):
+    # Short lines for the debug overlay on the panel.
+    return ['FPS ' + str(libtcod.sys_get_fps()) + ' frame ' + self.recent('frame'),
+      'fov ' + self.recent('fov') + ' ai ' + self.recent('ai'),
+      'draw ' + self.recent('render') + ' fl ' + self.recent('flush')]
+
+  def recent(self, name):
+    # The stage's mean time over recent calls, formatted for the overlay.
+    stage = self.stages.get(name)
+    if not stage:
+      return '-'
+    return '%.1f' % (sum(stage['recent']) / len(stage['recent']))
+
+  def record(self, name, ms):
+    stage = self.stages.get(name)
+    if stage is None:
+      stage = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'recent': collections.deque(maxlen = PROFILE_WINDOW),
+        'histogram': [0] * (len(self.BUCKETS) + 1)}
+      self.stages[name] = stage
+    stage['calls'] += 1
+    stage['total_ms'] += ms
+    stage['max_ms'] = max(stage['max_ms'], ms)
+    recent = stage['recent']
+    if len(recent) == recent.maxlen:
+      # The oldest time is about to drop out of the window, and out of the histogram.
+      stage['histogram'][bisect.bisect_left(self.BUCKETS, recent[0])] -= 1
+    recent.append(ms)
+    stage['histogram'][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+  def stage(self, name):
+    # Returns a context manager that times one run of a stage. Costs next to nothing when profiling is off.
+    if not self.enabled:
+      return NO_TIMER
+    return StageTimer(self, name)
+
+  def summary(self):
+    summary = {}
+    for (name, stage) in self.stages.items():
+      summary[name] = {'calls': stage['calls'], 'total_ms': stage['total_ms'], 'mean_ms': stage['total_ms'] / stage['calls'],
+        'max_ms': stage['max_ms'], 'recent_mean_ms': sum(stage['recent']) / len(stage['recent']),
+        'histogram': list(stage['histogram'])}
+    return summary
 
 class Rect:
   # A rectangle used on a map, namely for the creation of rooms.
+  __slots__ = ('x1', 'y1', 'x2', 'y2')
+
   def __init__(self, x, y, w, h):
     self.x1 = x
     self.y1 = y
@@ -353,12 +1097,260 @@ class Rect:
     center_y = (self.y1 + self.y2) // 2
     return center_x, center_y
 
-  def intersect(self, other):
-    # Returns True if this rect intersects with another one.
-    return (self.x1 <= other.x2 and self.x2 >= other.x1 and self.y1 <= other.y2 and self.y2 >= other.y1)
+class SaveWorker:
+  # Writes saves on a background thread, so the game never waits on the disk. save_game takes a snapshot of the
+  # game (plain data, so the game can go on changing) and hands it over; the thread encodes and writes it. Results
+  # come back through a queue, which poll() turns into messages: failures always, successes only for the saves
+  # the player asked for (not autosaves).
+  # The thread also owns the autosave journal: a save made for journaling starts a new one once the save is on
+  # disk (until then the old save and journal still match), and the deltas queued after it are appended to it.
+  def __init__(self):
+    self.jobs = queue.Queue()
+    self.results = queue.Queue()
+    self.thread = None
+    self.pending = 0
+    self.journal = None  # The open journal; only the thread touches it.
+
+  def append(self, delta):
+    # Queue a delta to be added to the journal.
+    self.start()
+    self.jobs.put(('delta', delta))
+
+  def close_journal(self):
+    # Queue the journal to be closed. wait() waits for it.
+    self.start()
+    self.pending += 1
+    self.jobs.put(('close',))
+
+  def finish(self, result):
+    # Report a finished job. Returns 1 if it was a save and failed, else 0.
+    (kind, announce, error) = result
+    if kind == 'journal':
+      message('Could not write the autosave journal: ' + str(error), libtcod.red)
+      return 0
+    self.pending -= 1
+    if error is None:
+      if announce:
+        message('Game saved.', libtcod.grey)
+      return 0
+    message('Could not save the game: ' + str(error), libtcod.red)
+    return 1
+
+  def open_journal(self, epoch):
+    # Start an empty journal for the save with the given epoch, in place of the old one.
+    self.stop_journal()
+    with open(JOURNAL_FILE + '.new', 'wb') as f:
+      savefile.write_journal_header(f, epoch)
+    os.replace(JOURNAL_FILE + '.new', JOURNAL_FILE)
+    self.journal = open(JOURNAL_FILE, 'ab')
+
+  def poll(self):
+    # Report the saves finished since the last poll. Returns the number that failed.
+    failures = 0
+    while True:
+      try:
+        failures += self.finish(self.results.get_nowait())
+      except queue.Empty:
+        return failures
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      if job[0] == 'delta':
+        if self.journal is None:
+          continue
+        try:
+          savefile.append_delta(self.journal, job[1])
+          self.journal.flush()
+        except Exception as error:
+          # Stop journaling until the next autosave; the journal so far is still good up to its last whole delta.
+          self.stop_journal()
+          self.results.put(('journal', False, error))
+      elif job[0] == 'close':
+        self.stop_journal()
+        self.results.put(('close', False, None))
+      else:
+        (kind, snapshot, announce, journal) = job
+        try:
+          write_save(snapshot)
+        except Exception as error:
+          self.results.put((kind, announce, error))
+          continue
+        self.results.put((kind, announce, None))
+        if journal:
+          try:
+            self.open_journal(snapshot['epoch'])
+          except Exception as error:
+            self.stop_journal()
+            self.results.put(('journal', False, error))
+
+  def start(self):
+    # Start the thread on first use.
+    if self.thread is None:
+      self.thread = threading.Thread(target = self.run, name = 'save', daemon = True)
+      self.thread.start()
+      atexit.register(self.wait)
+
+  def stop_journal(self):
+    # Close the journal, if one is open.
+    if self.journal is not None:
+      self.journal.close()
+      self.journal = None
+
+  def submit(self, snapshot, announce = True, journal = False):
+    # Queue a snapshot to be written. 'announce' reports the save when it's done; 'journal' starts a new autosave
+    # journal for it once it's written.
+    self.start()
+    self.pending += 1
+    self.jobs.put(('save', snapshot, announce, journal))
+
+  def wait(self):
+    # Block until every queued save is written. Returns the number of saves that failed.
+    failures = 0
+    while self.pending:
+      failures += self.finish(self.results.get())
+    return failures
+
+class Scheduler:
+  # The AI components of the objects on the map (it is stores['ai']), split into active ones, which take turns,
+  # and dormant ones far from the player, which cost nothing until the player comes near or a noise wakes them.
+  # Dormant monsters are filed by region, so waking looks only at the regions around the player and a turn costs
+  # as much as the monsters near the player, however many the level holds. Only AIs with can_sleep sleep.
+  def __init__(self):
+    self.active = ComponentStore()
+    self.dormant = {}  # Owner -> (component, region).
+    self.regions = {}  # Region (x, y) -> {owner: True} for the dormant objects in it.
+
+  def clear(self):
+    self.active.clear()
+    self.dormant = {}
+    self.regions = {}
+
+  def discard(self, owner):
+    self.active.discard(owner)
+    self.remove_dormant(owner)
+
+  def noise(self, x, y, radius = AI_NOISE_RADIUS):
+    # Wake the monsters within 'radius' of (x, y).
+    for rx in range((x - radius) // AI_REGION_SIZE, (x + radius) // AI_REGION_SIZE + 1):
+      for ry in range((y - radius) // AI_REGION_SIZE, (y + radius) // AI_REGION_SIZE + 1):
+        region = self.regions.get((rx, ry))
+        if region:
+          for owner in list(region):
+            if max(abs(owner.x - x), abs(owner.y - y)) <= radius:
+              self.active.set(owner, self.remove_dormant(owner))
+
+  def remove_dormant(self, owner):
+    # Take the owner out of the dormant set, returning its component (None if it wasn't dormant).
+    entry = self.dormant.pop(owner, None)
+    if entry is None:
+      return None
+    (component, key) = entry
+    region = self.regions[key]
+    del region[owner]
+    if not region:
+      del self.regions[key]
+    return component
+
+  def set(self, owner, component):
+    # Store the owner's component, replacing the one it had; None removes it. A dormant owner stays dormant
+    # unless its new AI can't sleep.
+    if component is None:
+      self.discard(owner)
+    elif owner in self.dormant and component.can_sleep:
+      self.dormant[owner] = (component, self.dormant[owner][1])
+    else:
+      self.remove_dormant(owner)
+      self.active.set(owner, component)
+
+  def sleep(self, owner, component):
+    key = (owner.x // AI_REGION_SIZE, owner.y // AI_REGION_SIZE)
+    self.active.discard(owner)
+    self.dormant[owner] = (component, key)
+    self.regions.setdefault(key, {})[owner] = True
+
+  def turn(self):
+    # Wake the monsters near the player and put the active ones that wandered far off to sleep, then return the
+    # AIs that take this turn. The wake radius covers the player's field of view and the monsters' sight, so no
+    # monster that could see or be seen by the player sleeps.
+    radius = max(light.TORCH_RADIUS, MONSTER_SIGHT_RADIUS) + AI_WAKE_MARGIN
+    self.noise(player.x, player.y, radius)
+    radius += AI_SLEEP_MARGIN
+    for (owner, component) in list(zip(self.active.owners, self.active.components)):
+      if component.can_sleep and max(abs(owner.x - player.x), abs(owner.y - player.y)) > radius:
+        self.sleep(owner, component)
+    return list(self.active.components)
+
+class ScriptedInput:
+  # A queue of input events that replaces the keyboard and mouse in headless games.
+  # An event is a character ('g', '>', ...), an arrow or key name ('up', 'down', 'left', 'right', 'enter', 'escape'),
+  # or a ('click', x, y) tuple for a left-click on a map cell.
+  KEY_NAMES = {'up': libtcod.KEY_UP, 'down': libtcod.KEY_DOWN, 'left': libtcod.KEY_LEFT, 'right': libtcod.KEY_RIGHT,
+    'enter': libtcod.KEY_ENTER, 'escape': libtcod.KEY_ESCAPE}
+
+  def __init__(self, events):
+    self.events = list(events)
+    self.position = 0
+
+  def exhausted(self):
+    return self.position >= len(self.events)
+
+  def next_event(self, key, mouse, default = 'escape', menu = False):
+    # Write the next event into 'key' and 'mouse', as sys_check_for_event would. Uses 'default' once the script runs out.
+    # A menu ('menu' True) only takes a character, enter or escape; it gets 'default' instead of an arrow or a click,
+    # which stay in the script for the game (e.g. a level-up menu in the middle of a script of moves).
+    if self.exhausted() or (menu and (isinstance(self.events[self.position], tuple) or
+        self.events[self.position] in ('up', 'down', 'left', 'right'))):
+      event = default
+    else:
+      event = self.events[self.position]
+      self.position += 1
+    key.vk = libtcod.KEY_NONE
+    key.c = 0
+    key.lalt = False
+    mouse.lbutton_pressed = False
+    mouse.rbutton_pressed = False
+    if isinstance(event, tuple):
+      (mouse.cx, mouse.cy) = event[1:]
+      mouse.lbutton_pressed = True
+    elif event in self.KEY_NAMES:
+      key.vk = self.KEY_NAMES[event]
+    else:
+      key.vk = libtcod.KEY_CHAR
+      key.c = ord(event)
+
+class SpawnTable:
+  # Chooses among kinds at random, each with its weight: the running totals of the weights are searched with
+  # bisect, so a choice takes one random number and a binary search.
+  def __init__(self, weights):
+    self.kinds = []
+    self.totals = []
+    total = 0
+    for (kind, weight) in weights:
+      total += weight
+      self.kinds.append(kind)
+      self.totals.append(total)
+
+  def choose(self, rnd):
+    dice = libtcod.random_get_int(rnd, 1, self.totals[-1])
+    return self.kinds[bisect.bisect_left(self.totals, dice)]
+
+class StageTimer:
+  # Context manager that times one run of a Profiler stage.
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+
+  def __exit__(self, *exc_info):
+    self.profiler.record(self.name, 1000.0 * (time.perf_counter() - self.start))
 
 class Status_Item_Regen:
   # A class for item-based status effects that regenerate the player.
+  __slots__ = ('owner', 'amount', 'chance')
+
   def __init__(self, owner, amount = 1, chance = 100):
     self.amount = amount
     self.chance = chance
@@ -368,15 +1360,62 @@ class Status_Item_Regen:
   def take_turn(self):
     if self.owner.equipment.check_equip():
       print("Something triggers.\n\n\n\n")
-      randint = libtcod.random_get_int(0, 1, 100)
+      randint = libtcod.random_get_int(rng['combat'], 1, 100)
       if randint <= self.chance:
         player.fighter.hp += self.amount
         if player.fighter.hp > player.fighter.max_hp:
           player.fighter.hp = player.fighter.max_hp
-
+        autosave.touch(player)
+
+
+class Template:
+  # A kind of monster or item, from ENTITY_FILE. Its prototype object and components are built once, when the
+  # file is loaded; spawning copies their slots instead of running every constructor again.
+  def __init__(self, data):
+    self.name = data['name']
+    self.chance = data.get('chance', [])
+    self.pack = data.get('pack', False)
+    prototype = GameObject(0, 0, data['char'], data['name'], getattr(libtcod, data['color']), data.get('blocks', False))
+    if 'fighter' in data:
+      fighter = data['fighter']
+      Fighter(prototype, fighter['hp'], fighter['defense'], fighter['power'], fighter['xp'],
+        saved_function(fighter.get('death', 'monster_death')), fighter.get('to_hit', 80), fighter.get('dodge', 0))
+    if 'ai' in data:
+      build_ai(prototype, data['ai'])
+    if 'item' in data:
+      Item(prototype, saved_function(data['item'].get('use')))
+    if 'equipment' in data:
+      Equipment(prototype, **data['equipment'])
+    if 'status' in data:
+      Status_Item_Regen(prototype, data['status']['amount'], data['status']['chance'])
+    self.prototype = prototype
+    self.fields = slot_values(prototype)
+    self.components = [(name, type(component), slot_values(component))
+      for (name, component) in self.fields if getattr(component, 'owner', None) is prototype]
+
+  def spawn(self, x, y):
+    # A new object of this kind at x, y (not yet on the map; see add_object).
+    obj = GameObject.__new__(GameObject)
+    for (name, value) in self.fields:
+      setattr(obj, name, value)
+    obj.x = x
+    obj.y = y
+    for (name, kind, fields) in self.components:
+      component = kind.__new__(kind)
+      for (field, value) in fields:
+        setattr(component, field, value)
+      component.owner = obj
+      setattr(obj, name, component)
+    return obj
+
+  def spawn_many(self, positions):
+    # New objects of this kind at each (x, y), e.g. to put on the map with add_objects.
+    return [self.spawn(x, y) for (x, y) in positions]
 
 class Tile:
   # A tile on the map
+  __slots__ = ('blocked', 'block_sight', 'explored')
+
   def __init__(self, blocked, block_sight = None):
     self.blocked = blocked
     # By default, if a tile is blocked, it also blocks sight.
@@ -385,6 +1424,190 @@ class Tile:
     self.block_sight = block_sight
     self.explored = False
 
+class TileColumn:
+  # One column of a TileGrid, so that old-style map[x][y] access keeps working.
+  def __init__(self, grid, x):
+    self.grid = grid
+    self.x = x
+
+  def __getitem__(self, y):
+    return TileView(self.grid, self.grid.index(self.x, y))
+
+  def __len__(self):
+    return self.grid.height
+
+  def __setitem__(self, y, tile):
+    # Copy the properties of a stand-alone Tile into the grid.
+    view = self[y]
+    view.blocked = tile.blocked
+    view.block_sight = tile.block_sight
+    view.explored = tile.explored
+
+class TileGrid:
+  # The map, stored as one flat bytearray per tile property instead of one Tile object per cell.
+  # Cells are stored row by row, so (x, y) lives at index y * width + x.
+  def __init__(self, width, height, blocked = True, block_sight = None):
+    self.width = width
+    self.height = height
+    # By default, if a tile is blocked, it also blocks sight.
+    if block_sight == None:
+      block_sight = blocked
+    size = width * height
+    self.blocked = bytearray([blocked]) * size
+    self.block_sight = bytearray([block_sight]) * size
+    self.explored = bytearray(size)
+    # Cells currently in the player's FOV, kept up to date by update_visible().
+    self.visible = bytearray(size)
+    # Bumped whenever blocked or block_sight change after the map is made, so cached fields of view can be dropped,
+    # and the cells changed since the FOV map was last brought up to date (see sync_fov). Code that writes the
+    # arrays directly must bump the version and list the cells too.
+    self.version = 0
+    self.changed = set()
+
+  def __getitem__(self, x):
+    # Old-style map[x][y] access, returning a Tile-like view.
+    return TileColumn(self, x)
+
+  def __len__(self):
+    return self.width
+
+  def index(self, x, y):
+    # Returns the position of (x, y) in the flat arrays.
+    return y * self.width + x
+
+class TileView:
+  # A Tile-like view of one cell of a TileGrid. Reads and writes go straight to the grid's arrays.
+  def __init__(self, grid, i):
+    self.grid = grid
+    self.i = i
+
+  @property
+  def blocked(self):
+    return bool(self.grid.blocked[self.i])
+
+  @blocked.setter
+  def blocked(self, value):
+    self.grid.blocked[self.i] = bool(value)
+    self.grid.version += 1
+    self.grid.changed.add(self.i)
+    autosave.touch_cells((self.i,))
+
+  @property
+  def block_sight(self):
+    return bool(self.grid.block_sight[self.i])
+
+  @block_sight.setter
+  def block_sight(self, value):
+    self.grid.block_sight[self.i] = bool(value)
+    self.grid.version += 1
+    self.grid.changed.add(self.i)
+    autosave.touch_cells((self.i,))
+
+  @property
+  def explored(self):
+    return bool(self.grid.explored[self.i])
+
+  @explored.setter
+  def explored(self, value):
+    self.grid.explored[self.i] = bool(value)
+    autosave.touch_cells((self.i,))
+
+class VisibilityService:
+  # Fields of view for any number of origins (e.g. every monster), so AI can ask what a monster sees without
+  # recomputing its FOV every turn. Fields of view are computed on one scratch FOV map, built from the map's arrays,
+  # and each is cached by (x, y, radius, map version), keeping the VISIBILITY_CACHE_SIZE most recently used.
+  def __init__(self):
+    self.fov = None
+    self.grid = None
+    self.version = None
+    self.cache = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def can_see(self, x, y, target_x, target_y, radius = MONSTER_SIGHT_RADIUS):
+    # Is (target_x, target_y) in the field of view from (x, y)?
+    return self.in_view(self.view(x, y, radius), target_x, target_y)
+
+  def compute(self, origins, radius = MONSTER_SIGHT_RADIUS):
+    # Returns the fields of view from a list of (x, y) origins, computing only those not in the cache.
+    self.sync()
+    views = []
+    for (x, y) in origins:
+      key = (x, y, radius, self.version)
+      view = self.cache.get(key)
+      if view is None:
+        self.misses += 1
+        view = self.read_view(x, y, radius)
+        self.cache[key] = view
+        if len(self.cache) > VISIBILITY_CACHE_SIZE:
+          self.cache.popitem(last = False)
+      else:
+        self.hits += 1
+        self.cache.move_to_end(key)
+      views.append(view)
+    return views
+
+  def in_view(self, view, x, y):
+    (x0, y0, width, height, cells) = view
+    if x0 <= x < x0 + width and y0 <= y < y0 + height:
+      return cells[(y - y0) * width + (x - x0)] == 1
+    return False
+
+  def line_of_sight(self, x, y, target_x, target_y):
+    # Is there a straight line between the two cells that nothing blocks sight along?
+    for (line_x, line_y) in libtcod.line_iter(x, y, target_x, target_y):
+      if (line_x, line_y) != (target_x, target_y) and map.block_sight[map.index(line_x, line_y)]:
+        return False
+    return True
+
+  def read_view(self, x, y, radius):
+    # Compute the FOV from (x, y) and copy out the part of it that can be lit: (x0, y0, width, height, cells).
+    libtcod.map_compute_fov(self.fov, x, y, radius, FOV_LIGHT_WALLS, FOV_ALGO)
+    if radius > 0:
+      x0, y0 = max(0, x - radius), max(0, y - radius)
+      width = min(map.width, x + radius + 1) - x0
+      height = min(map.height, y + radius + 1) - y0
+    else:
+      x0, y0, width, height = 0, 0, map.width, map.height
+    return (x0, y0, width, height, read_fov(self.fov, x0, y0, width, height))
+
+  def reset(self):
+    # Forget everything, e.g. when a new map is made.
+    if self.fov is not None:
+      libtcod.map_delete(self.fov)
+    self.fov = None
+    self.grid = None
+    self.cache.clear()
+
+  def sync(self):
+    # Make sure the scratch FOV map matches the current map, dropping cached views if it changed.
+    if self.grid is not map or self.version != map.version:
+      if self.fov is None or self.grid is not map:
+        self.reset()
+        self.fov = libtcod.map_new(map.width, map.height)
+      libtcod.map_set_buffers(self.fov, map.block_sight.translate(INVERT), map.blocked.translate(INVERT))
+      self.grid = map
+      self.version = map.version
+      self.cache.clear()
+
+  def view(self, x, y, radius = MONSTER_SIGHT_RADIUS):
+    # The field of view from a single origin.
+    return self.compute([(x, y)], radius)[0]
+
+autosave = Autosave()
+flow = FlowField()
+scheduler = Scheduler()
+stores = {'fighter': ComponentStore(), 'ai': scheduler, 'status_effect': ComponentStore()}
+levels = LevelArchive()
+paths = PathService()
+pregen = LevelPool()
+profiler = Profiler()
+saver = SaveWorker()
+visibility = VisibilityService()
+if PROFILING:
+  profiler.enable()
+NO_TIMER = contextlib.nullcontext()
+
 #############################################
 # Functions
 #############################################
@@ -406,8 +1629,9 @@ def cast_fireball():
   if x is None:
     return 'cancelled'
   message('The fireball explodes, burning everything within ' + str(FIREBALL_RADIUS) + ' tiles!', libtcod.orange)
+  scheduler.noise(x, y)
   # Damage every fighter-object in range, including the player.
-  for obj in gameobjects:
+  for obj in list(stores['fighter'].owners):
     if obj.distance(x, y) <= FIREBALL_RADIUS and obj.fighter:
       message('The ' + obj.name + ' gets burned for ' + str(FIREBALL_DAMAGE) + ' hit points.', libtcod.orange)
       obj.fighter.take_damage(FIREBALL_DAMAGE)
@@ -430,12 +1654,95 @@ def cast_lightning():
   message('A lighting bolt strikes the ' + monster.name + ' with a loud thunder! The damage is ' + str(LIGHTNING_DAMAGE) + ' hit points.', libtcod.light_blue)
   monster.fighter.take_damage(LIGHTNING_DAMAGE)
 
+def add_object(obj):
+  # Put an object on the map: add it to gameobjects, the occupancy index and the component stores.
+  gameobjects.append(obj)
+  occupancy.add(obj)
+  obj.place(True)
+  autosave.reorder(obj)
+  mark_dirty(obj.x, obj.y)
+
+def add_objects(objs):
+  # Put many objects on the map at once.
+  gameobjects.extend(objs)
+  for obj in objs:
+    occupancy.add(obj)
+    obj.place(True)
+    autosave.reorder(obj)
+    dirty_cells.add(map.index(obj.x, obj.y))
+
+def ai_record(ai):
+  # The saved form of an AI component: (kind, num_turns, old kind).
+  if isinstance(ai, AI_ConfusedMonster):
+    return ('confused', ai.num_turns, ai_record(ai.old_ai)[0])
+  return ('basic', 0, None)
+
+def build_ai(owner, kind, num_turns = 0, old_kind = None):
+  # Create an AI component from its saved form.
+  if kind == 'confused':
+    old_ai = build_ai(owner, old_kind)
+    return AI_ConfusedMonster(owner, old_ai, num_turns)
+  return AI_BasicMonster(owner)
+
+def build_grid(grid):
+  # Create a TileGrid from its saved form, (width, height, flags) (see savefile.py).
+  (width, height, flags) = grid
+  tiles = TileGrid(width, height, False)
+  for (bit, array) in enumerate([tiles.blocked, tiles.block_sight, tiles.explored]):
+    array[:] = flags.translate(bytes((code >> bit) & 1 for code in range(256)))
+  return tiles
+
+def build_object(record):
+  # Create a GameObject and its components from its saved record (see savefile.py).
+  (x, y, char, name, color, blocks, always_visible, level, fighter, ai, item, equipment, status) = record
+  obj = GameObject(x, y, char, name, libtcod.Color(*color), blocks, always_visible)
+  if level:
+    obj.level = level
+  if fighter:
+    (max_hp, hp, defense, power, dodge, xp, to_hit, death_function) = fighter
+    Fighter(obj, max_hp, defense, power, xp, saved_function(death_function), to_hit, dodge)
+    obj.fighter.hp = hp
+  if ai:
+    build_ai(obj, *ai)
+  if item:
+    Item(obj, saved_function(item[0]))
+  if equipment:
+    (slot, power, defense, max_hp, torch, dodge, is_equipped) = equipment
+    Equipment(obj, slot, power, defense, max_hp, torch, dodge)
+    obj.equipment.is_equipped = is_equipped
+  if status:
+    Status_Item_Regen(obj, status[1], status[2])
+  return obj
+
+def bytes_or(a, b):
+  # Returns the cell-by-cell OR of two 0/1 byte arrays, computed on the whole arrays at once.
+  return (int.from_bytes(a, 'big') | int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+def carve(cells):
+  # Make the cells of a slice of the map's arrays passable and see-through.
+  size = len(range(*cells.indices(len(map.blocked))))
+  map.blocked[cells] = bytes(size)
+  map.block_sight[cells] = bytes(size)
+  map.version += 1
+  map.changed.update(range(*cells.indices(len(map.blocked))))
+
+def changed_cells(a, b):
+  # Returns the indices where two 0/1 byte arrays differ.
+  diff = (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+  cells = []
+  i = diff.find(1)
+  while i != -1:
+    cells.append(i)
+    i = diff.find(1, i + 1)
+  return cells
+
 def check_level_up():
   # See if the player's experience is enough to level-up.
   level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
   if player.fighter.xp >= level_up_xp:
     # Level up.
     player.level += 1
+    autosave.touch(player)
     player.fighter.xp -= level_up_xp
     message('Your battle skills grow stronger! You reached level ' + str(player.level) + '!', libtcod.yellow)
     choice = None
@@ -455,8 +1762,8 @@ def closest_monster(max_range):
   # Find closest enemy, up to a maximum range, and in the player's FOV.
   closest_enemy = None
   closest_dist = max_range + 1 # Start with (slightly more than) maximum range.
-  for object in gameobjects:
-    if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+  for object in stores['fighter'].owners:
+    if not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
       # Calculate distance between this object and the player.
       dist = player.distance_to(object)
       if dist < closest_dist:  # It's closer, so remember it.
@@ -464,59 +1771,199 @@ def closest_monster(max_range):
         closest_dist = dist
   return closest_enemy
 
+def combine_flags(*arrays):
+  # Packs several 0/1 byte arrays into one array of small codes: the first array gives bit 0, the next bit 1, etc.
+  # Each array is treated as one big integer, so no Python-level loop runs over the cells.
+  value = 0
+  for bit, array in enumerate(arrays):
+    value |= int.from_bytes(array, 'big') << bit
+  return value.to_bytes(len(arrays[0]), 'big')
+
 def create_h_tunnel(x1, x2, y):
-  global map
-  for x in range(min(x1, x2), max(x1, x2) + 1):
-    map[x][y].blocked = False
-    map[x][y].block_sight = False
+  # A tunnel along a row is one slice of the arrays.
+  carve(slice(map.index(min(x1, x2), y), map.index(max(x1, x2), y) + 1))
 
 def create_room(room):
-  global map, gameobjects
-  # Create passable areas in rooms, carved out via rects from map.
-  for x in range(room.x1 + 1, room.x2):
-    for y in range(room.y1 + 1, room.y2):
-      map[x][y].blocked = False
-      map[x][y].block_sight = False
+  # Create passable areas in rooms, carved out via rects from map, a row at a time.
+  for y in range(room.y1 + 1, room.y2):
+    carve(slice(map.index(room.x1 + 1, y), map.index(room.x2, y)))
 
 def create_v_tunnel(y1, y2, x):
-  global map
-  for y in range(min(y1, y2), max(y1, y2) + 1):
-    map[x][y].blocked = False
-    map[x][y].block_sight = False
+  # A tunnel along a column is a slice of the arrays with a step of one row.
+  carve(slice(map.index(x, min(y1, y2)), map.index(x, max(y1, y2)) + 1, map.width))
+
+def draw_frame(changed):
+  # Draw what changed since the last frame onto 'con' and 'panel', and blit them to the root console.
+  # 'changed' lists the cells whose visibility just changed, or is None if the FOV wasn't recomputed.
+  global redraw_all, panel_key
+
+  # Count the console operations this frame needs, so idle frames can be seen to cost nothing.
+  cost = 0
+  if changed is not None:
+    # Repaint the background of the whole map in one call. Tiles outside FOV are only shown if they've been explored.
+    fill_map_background(combine_flags(map.explored, map.visible, map.block_sight))
+    cost += 1
+    # Objects may have come into or gone out of view wherever the FOV changed.
+    dirty_cells.update(changed)
+
+  # Redraw the objects on cells that changed, or all of them if the whole screen is stale.
+  if redraw_all:
+    # Erase the cells objects have left (e.g. during a turn taken from a menu) before drawing every object.
+    cost += redraw_cells(dirty_cells)
+    dirty_cells.clear()
+    for object in gameobjects:
+      if object != player:
+        object.draw()
+    player.draw()
+    cost += len(gameobjects)
+  elif dirty_cells:
+    cost += redraw_cells(dirty_cells)
+    dirty_cells.clear()
+  map_changed = cost > 0 or redraw_all
+
+  # The panel only changes with messages, player stats, the level, the mouse, or what's on the map.
+  # When profiling, it also shows the live timings.
+  overlay = profiler.overlay_lines() if profiler.enabled else None
+  new_panel_key = (message_serial, player.fighter.hp, player.fighter.max_hp, dungeon_level, mouse.cx, mouse.cy, overlay)
+  panel_changed = map_changed or new_panel_key != panel_key
+  panel_key = new_panel_key
+  redraw_all = False
+  render_stats['frames'] += 1
+  if not panel_changed:
+    # Nothing changed: the root console still holds this frame.
+    render_stats['idle_frames'] += 1
+    render_stats['last_cost'] = 0
+    return
+
+  # Blit the contents of 'con' to the root console.
+  if map_changed:
+    libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+    cost += 1
+
+  # Prepare to render the GUI panel.
+  libtcod.console_set_default_background(panel, libtcod.black)
+  libtcod.console_clear(panel)
+
+  # Print the game messages, one line at a time.
+  y = 1
+  for (line, color) in game_msgs:
+    libtcod.console_set_default_foreground(panel, color)
+    libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+    y += 1
+
+  # Show the player's stats.
+  render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp, libtcod.light_red, libtcod.darker_red)
+  libtcod.console_print_ex(panel, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Dungeon level ' + str(dungeon_level))
+
+  # Display names of gameobjects under the mouse.
+  libtcod.console_set_default_foreground(panel, libtcod.light_gray)
+  libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+
+  # Debug overlay: frames per second and recent ms per stage.
+  if overlay:
+    for (i, line) in enumerate(overlay):
+      libtcod.console_print_ex(panel, 1, 4 + i, libtcod.BKGND_NONE, libtcod.LEFT, line)
+
+  # Blit the contents of "panel" to the root console.
+  libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+  cost += 2
+  render_stats['cost'] += cost
+  render_stats['last_cost'] = cost
+
+def draw_menu(header, options, width):
+  # calculate total height for the header (after auto-wrap) WITH one line per option.
+  header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+  if header == '':
+        header_height = 0
+  height = len(options) + header_height
+  # Create an off-screen console that represents the menu's window.
+  window = libtcod.console_new(width, height)
+  # Print the header, with auto-wrap
+  libtcod.console_set_default_foreground(window, libtcod.white)
+  libtcod.console_print_rect_ex(window, 0, 0, width, height, libtcod.BKGND_NONE, libtcod.LEFT, header)
+  # Print all the options.
+  y = header_height
+  letter_index = ord('a')
+  for option_text in options:
+    text = '(' + chr(letter_index) + ') ' + option_text
+    libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
+    y += 1
+    letter_index += 1
+  # Blit the contents of "window" to the root console.
+  x = SCREEN_WIDTH//2 - width//2
+  y = SCREEN_HEIGHT//2 - height//2
+  libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+  # Present the root console to the player.
+  libtcod.console_flush()
+
+def enter_level(record, arrival):
+  # Make a level from the archive the current one, with the player arriving on its 'stairs' or 'upstairs'.
+  global map, gameobjects, stairs, upstairs
+  if record is None:
+    # The archive doesn't have it after all (e.g. its file was lost): make the level afresh from its seed.
+    make_map()
+    record = level_record()
+  map = build_grid(record['grid'])
+  gameobjects = [build_object(obj) for obj in record['objects']]
+  stairs = gameobjects[record['stairs']]
+  upstairs = gameobjects[record['upstairs']] if record['upstairs'] >= 0 else None
+  index_objects()
+  arrive_at = stairs if arrival == 'stairs' else upstairs
+  player.x = arrive_at.x
+  player.y = arrive_at.y
+  add_object(player)
+
+def fill_map_background(cells):
+  # Set the background of every cell of 'con' with a single call, from the codes built in render_all.
+  global color_tables
+  if color_tables is None:
+    # Translation tables from a cell code to each color channel.
+    color_tables = [bytes(color[channel] for color in cell_colors).ljust(256, b'\0') for channel in range(3)]
+  # Lay the map rows out with the console's width, padding anything outside the map with code 0 (black).
+  width = min(map.width, SCREEN_WIDTH)
+  rows = []
+  for y in range(SCREEN_HEIGHT):
+    if y < map.height:
+      start = map.index(0, y)
+      rows.append(cells[start:start + width].ljust(SCREEN_WIDTH, b'\0'))
+    else:
+      rows.append(bytes(SCREEN_WIDTH))
+  codes = b''.join(rows)
+  r, g, b = [codes.translate(table) for table in color_tables]
+  libtcod.console_fill_background(con, r, g, b)
 
-def from_dungeon_level(table):
+def from_dungeon_level(table, current = None):
   # Returns a value that depends on level. The table specifies what value occurs after each level, default is 0.
+  if current is None:
+    current = dungeon_level
   for (value, level) in reversed(table):
-    if dungeon_level >= level:
+    if current >= level:
       return value
   return 0
 
-def get_all_equipped(obj):
-  # Returns a list of equipped items.
-  if obj == player:
-    equipped_list = []
-    for item in inventory:
-      if item.equipment and item.equipment.is_equipped:
-        equipped_list.append(item.equipment)
-    return equipped_list
-  else:
-    return [] # Other gameobjects have no equipment
+def generate_level(seed, level, settings = None):
+  # Run in a worker process (see LevelPool): make level 'level' of the game with the given seed and settings
+  # (map size, rooms, monster density), with a stand-in player, and return it encoded as a level record.
+  global game_seed, dungeon_level, player
+  if settings:
+    globals().update(settings)
+  game_seed = seed
+  dungeon_level = level
+  player = GameObject(0, 0, '@', 'player', libtcod.white, blocks=True)
+  make_map()
+  return savefile.dumps(level_record())
 
 def get_equipped_in_slot(slot):
-  global inventory
   # Returns the equipment in a slot, or None if it's empty.
-  for obj in inventory:
-    if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-      return obj.equipment
-  return None
+  return player.equipment_stats.slots.get(slot)
 
 def get_names_under_mouse():
   global mouse
   # Return a string with the names of all gameobjects under the mouse
   (x, y) = (mouse.cx, mouse.cy)
   # Create a list with the names of all gameobjects at the mouse's coordinates and in FOV.
-  names = [obj.name for obj in gameobjects
-    if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+  names = [obj.name for obj in occupancy.at(x, y)
+    if libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
 
   names = ', '.join(names)  # Join the names, separated by commas.
   return names.capitalize()
@@ -551,8 +1998,8 @@ def handle_keys():
       # Pick up an item.
       if key_char == 'g':
         # Look for an item in the player's tile.
-        for object in gameobjects:
-          if object.x == player.x and object.y == player.y and object.item:
+        for object in occupancy.at(player.x, player.y):
+          if object.item:
             object.item.pick_up()
             break
       if key_char == 'i':
@@ -569,26 +2016,57 @@ def handle_keys():
         # Go down stairs, if the player is on them
         if stairs.x == player.x and stairs.y == player.y:
           next_level()
+      if key_char == '<':
+        # Go up stairs, if the player is on them
+        if upstairs and upstairs.x == player.x and upstairs.y == player.y:
+          prev_level()
       if key_char == 'c':
         # Show character information.
         level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
         msgbox('Character Information\n\nLevel: ' + str(player.level) + '\nExperience: ' + str(player.fighter.xp) + '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum HP: ' + str(player.fighter.max_hp) + '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense) + '\nDodge: ' + str(player.fighter.dodge), CHARACTER_SCREEN_WIDTH)
       if key_char == '?':
         # Show help.
-        msgbox('Press the following keys for results.\n\nArrow Keys: Move.\nc: Inventory for use.\nd: Inventory for drop.\nShift + > when on stairs down: Go down.')
+        msgbox('Press the following keys for results.\n\nArrow Keys: Move.\nc: Inventory for use.\nd: Inventory for drop.\nShift + > when on stairs down: Go down.\nShift + < when on stairs up: Go up.')
 
       return 'didnt-take-turn'
 
+def index_objects():
+  # Rebuild the occupancy index and the component stores from scratch, e.g. after loading a game.
+  global occupancy
+  occupancy = OccupancyGrid(map.width, map.height)
+  for store in stores.values():
+    store.clear()
+  for obj in gameobjects:
+    occupancy.add(obj)
+    obj.place(True)
+
+def init_console(headless_mode = False):
+  # Open the window and create the off-screen consoles. A headless game has neither, and draws nothing.
+  global con, panel, headless
+  headless = headless_mode
+  if headless:
+    con = None
+    panel = None
+    return
+  libtcod.console_set_custom_font(b'arial12x12.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+  libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, b'python/libtcod tutorial', False)
+  libtcod.sys_set_fps(LIMIT_FPS)
+  con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+  panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
 def initialize_fov():
-  global fov_recompute, fov_map
+  global fov_recompute, fov_map, redraw_all
   fov_recompute = True
+  redraw_all = True
   # Create the FOV map, in accordance with the established Map
   fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-  for y in range(MAP_HEIGHT):
-    for x in range(MAP_WIDTH):
-      libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+  visibility.reset()
+  # All cells at once, from the map's arrays with 0 and 1 swapped.
+  libtcod.map_set_buffers(fov_map, map.block_sight.translate(INVERT), map.blocked.translate(INVERT))
+  map.changed.clear()
   # Clear Console
-  libtcod.console_clear(con)
+  if not headless:
+    libtcod.console_clear(con)
 
 def inventory_menu(header):
   # Show a menu with each item of the inventory as an option.
@@ -610,34 +2088,49 @@ def inventory_menu(header):
   return inventory[index].item
 
 def is_blocked(x, y):
-  global gameobjects
   # First, test if the map tile is blocking.
-  if map[x][y].blocked:
+  i = map.index(x, y)
+  if map.blocked[i]:
     return True
   # Now check to see if there are any blocking gameobjects.
-  for object in gameobjects:
-    if object.blocks and object.x == x and object.y == y:
-      return True
+  if occupancy.blockers[i]:
+    return True
   # Otherwise, not blocked.
   return False
 
+def level_record():
+  # The current level as plain data for the archive: the map and everything on it but the player.
+  objects = [obj for obj in gameobjects if obj is not player]
+  return {
+    'grid': (map.width, map.height, combine_flags(map.blocked, map.block_sight, map.explored)),
+    'objects': [object_record(obj) for obj in objects],
+    'stairs': objects.index(stairs),
+    'upstairs': objects.index(upstairs) if upstairs else -1,
+    'dungeon_level': dungeon_level,
+  }
+
 def load_game():
-  # Open the previously saved shelve and load the game data.
-  global map, gameobjects, stairs, dungeon_level
-  global player, inventory
-  global game_msgs, game_state
-  file = shelve.open('savegame', 'r')
-  map = file['map']
-  gameobjects = file['objects']
-  player = gameobjects[file['player_index']] # Get index of player in gameobjects list and access it.
-  inventory = file['inventory']
-  game_msgs = file['game_msgs']
-  game_state = file['game_state']
-  stairs = gameobjects[file['stairs_index']]
-  dungeon_level = file['dungeon_level']
-  file.close()
-  # Initialize the FOV
-  initialize_fov()
+  # Open the previously saved game and load the game data, replaying the autosave journal if there is one for it.
+  # Saves still being written, and the journal, are finished first.
+  saver.wait()
+  with open(SAVE_FILE, 'rb') as f:
+    snapshot = savefile.read(f)
+  if os.path.exists(JOURNAL_FILE):
+    with open(JOURNAL_FILE, 'rb') as f:
+      (epoch, deltas) = savefile.read_journal(f)
+    if epoch == snapshot.get('epoch'):
+      snapshot = savefile.apply_deltas(snapshot, deltas)
+  restore_state(snapshot)
+  levels.open(LEVEL_FILE, serial = snapshot.get('levels'))
+
+def load_templates():
+  # Read the monster and item templates from ENTITY_FILE, once.
+  global templates
+  if templates is None:
+    with open(ENTITY_FILE) as f:
+      data = json.load(f)
+    templates = {'monsters': [Template(entry) for entry in data['monsters']], 'items': [Template(entry) for entry in data['items']]}
+  return templates
 
 def main_menu():
   img = libtcod.image_load(b'menu_background3.png')
@@ -651,9 +2144,7 @@ def main_menu():
     # Show options and wait for the player's choice.
     choice = menu('', ['Play a new game', 'Continue last game', 'Quit'], 24)
     if choice == 0: # New Game
-      global light
-      light = Light()
-      new_game()
+      new_game(archive = LEVEL_FILE)
       play_game()
     elif choice == 1:  #load last game
       try:
@@ -666,53 +2157,68 @@ def main_menu():
       break
 
 def make_map():
-  global map, player, gameobjects, stairs
-
-  # The List of GameObjects
-  gameobjects = [player]
+  global map, player, gameobjects, stairs, upstairs, occupancy
+
+  # The level's random numbers all come from its own streams.
+  seed_stream('mapgen', dungeon_level)
+  seed_stream('spawn', dungeon_level)
+  # The List of GameObjects, and the index of where they are. The player is added once placed in the first room.
+  gameobjects = []
+  occupancy = OccupancyGrid(MAP_WIDTH, MAP_HEIGHT)
+  for store in stores.values():
+    store.clear()
   # Fill the map with "blocked" tiles.
-  map = [[ Tile(True)
-    for y in range(MAP_HEIGHT) ]
-      for x in range(MAP_WIDTH) ]
+  map = TileGrid(MAP_WIDTH, MAP_HEIGHT, True)
   rooms = []
+  # The cells covered by rooms so far, walls included, so a new room is checked against them all at once.
+  room_cells = bytearray(MAP_WIDTH * MAP_HEIGHT)
   num_rooms = 0
   for r in range(MAX_ROOMS):
     # Random width and height for rooms.
-    w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-    h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+    w = libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+    h = libtcod.random_get_int(rng['mapgen'], ROOM_MIN_SIZE, ROOM_MAX_SIZE)
     # Random position without going out of the boundaries of the map.
-    x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-    y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+    x = libtcod.random_get_int(rng['mapgen'], 0, MAP_WIDTH - w - 1)
+    y = libtcod.random_get_int(rng['mapgen'], 0, MAP_HEIGHT - h - 1)
 
     new_room = Rect(x, y, w, h)
 
-    # Run through the other rooms and see if they intersect with the new_room.
+    # See if the new_room intersects any other room: whether any of its cells is already covered.
     room_failed = False
-    for other_room in rooms:
-      if new_room.intersect(other_room):
+    for row in range(new_room.y1, new_room.y2 + 1):
+      if room_cells.find(1, map.index(new_room.x1, row), map.index(new_room.x2, row) + 1) != -1:
         room_failed = True
         break
 
     if not room_failed:
       # There are no intersections, so this new_room is valid.
       create_room(new_room)
-
-      # Create and place some gameobjects / monsters!
-      place_objects(new_room)
+      for row in range(new_room.y1, new_room.y2 + 1):
+        room_cells[map.index(new_room.x1, row):map.index(new_room.x2, row) + 1] = b'\x01' * (new_room.x2 - new_room.x1 + 1)
 
       # Center coordinates of new room.
       new_x, new_y = new_room.center()
 
       if num_rooms == 0:
-        # If first room, initiate player at center tuple.
+        # If first room, initiate player at center tuple (before placing monsters, so none spawn on the player).
         player.x = new_x
         player.y = new_y
-      else: # If not the first room, make some tunnels.
+        upstairs = None
+        if dungeon_level > 1:
+          # The stairs back up are where the player arrives.
+          upstairs = GameObject(new_x, new_y, '<', 'stairs up', libtcod.white, always_visible = True)
+          add_object(upstairs)
+        add_object(player)
+
+      # Create and place some gameobjects / monsters!
+      place_objects(new_room)
+
+      if num_rooms > 0: # If not the first room, make some tunnels.
         # Center coordinates of previous room.
         prev_x, prev_y = rooms[num_rooms - 1].center()
 
         # Random 50/50 (random number that is either 0 or 1)
-        if libtcod.random_get_int(0, 0, 1) == 1:
+        if libtcod.random_get_int(rng['mapgen'], 0, 1) == 1:
           # First move horizontally, then vertically.
           create_h_tunnel(prev_x, new_x, prev_y)
           create_v_tunnel(prev_y, new_y, new_x)
@@ -726,10 +2232,16 @@ def make_map():
       num_rooms += 1
   # Create stairs at the center of the last room
   stairs = GameObject(new_x, new_y, '>', 'stairs', libtcod.white, always_visible = True)
-  gameobjects.append(stairs)
+  add_object(stairs)
   stairs.send_to_back()  # So it's drawn below the monsters
 
+def mark_dirty(x, y):
+  # Flag a map cell whose contents changed, so the next render_all redraws it.
+  dirty_cells.add(map.index(x, y))
+
 def message(new_msg, color = libtcod.white):
+  global message_serial
+  message_serial += 1
   # Split the message along multiple lines if necessary.
   new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
   for line in new_msg_lines:
@@ -744,7 +2256,10 @@ def monster_death(monster):
   message(monster.name.capitalize() + ' is dead! You gain ' + str(monster.fighter.xp) + ' experience points.', libtcod.orange)
   monster.char = '%'
   monster.color = libtcod.dark_red
-  monster.blocks = False
+  autosave.touch(monster)
+  mark_dirty(monster.x, monster.y)
+  occupancy.set_blocks(monster, False)
+  paths.forget(monster)
   monster.fighter = None
   monster.ai = None
   monster.name = 'remains of ' + monster.name
@@ -753,31 +2268,11 @@ def monster_death(monster):
 def menu(header, options, width):
   if len(options) > 26:
     raise ValueError('Cannot have a menu with more than 26 options.')
-  # calculate total height for the header (after auto-wrap) WITH one line per option.
-  header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
-  if header == '':
-        header_height = 0
-  height = len(options) + header_height
-  # Create an off-screen console that represents the menu's window.
-  window = libtcod.console_new(width, height)
-  # Print the header, with auto-wrap
-  libtcod.console_set_default_foreground(window, libtcod.white)
-  libtcod.console_print_rect_ex(window, 0, 0, width, height, libtcod.BKGND_NONE, libtcod.LEFT, header)
-  # Print all the options.
-  y = header_height
-  letter_index = ord('a')
-  for option_text in options:
-    text = '(' + chr(letter_index) + ') ' + option_text
-    libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
-    y += 1
-    letter_index += 1
-  # Blit the contents of "window" to the root console.
-  x = SCREEN_WIDTH//2 - width//2
-  y = SCREEN_HEIGHT//2 - height//2
-  libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
-  # Present the root console to the player and wait for a key-press.
-  libtcod.console_flush()
-  key = libtcod.console_wait_for_keypress(True)
+  if not headless:
+    draw_menu(header, options, width)
+  key = wait_for_keypress()
+  # The menu was drawn over the game screen, which must be redrawn once it's gone.
+  render_invalidate()
   if key.vk == libtcod.KEY_ENTER and key.lalt:  #(special case) Alt+Enter: toggle fullscreen
     libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
   # Convert the ASCII code to an index; if it corresponds to an option, return it.
@@ -791,24 +2286,46 @@ def msgbox(text, width = 50):
 
 def next_level():
   global dungeon_level
-  # Advance to the next level
-  message('You take a moment to rest, and recover your strength.', libtcod.light_violet)
-  player.fighter.heal(player.fighter.max_hp // 2)  #heal the player by 50%
-  message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', libtcod.red)
+  # Advance to the next level, keeping the one being left in the archive.
+  levels.put(dungeon_level, level_record())
   dungeon_level += 1
-  make_map()  # Create a fresh new level.
+  record = levels.get(dungeon_level)
+  if record is not None:
+    message('You descend the stairs again.', libtcod.red)
+    enter_level(record, 'upstairs')
+  else:
+    message('You take a moment to rest, and recover your strength.', libtcod.light_violet)
+    player.fighter.heal(player.fighter.max_hp // 2)  #heal the player by 50%
+    message('After a rare moment of peace, you descend deeper into the heart of the dungeon...', libtcod.red)
+    # Use the level generated ahead of time if there is one, else create a fresh new level.
+    record = pregen.take(dungeon_level)
+    if record is not None:
+      enter_level(record, 'upstairs')
+    else:
+      make_map()
   initialize_fov()
 
-def new_game():
+def new_game(seed = None, archive = None):
+  # Start a new game. 'archive' is the file for the levels the player leaves (see LevelArchive), for games that
+  # will be saved; other games (headless, benchmarks) keep them in a temporary file, leaving any save alone.
   global game_msgs, game_state
   global inventory, dungeon_level
-  global player
+  global player, light, game_seed
+  if seed is None:
+    seed = GAME_SEED
+  # Saves keep the seed in 32 bits, so any other integer is reduced to that.
+  game_seed = seed & 0xFFFFFFFF if seed is not None else int.from_bytes(os.urandom(4), 'little')
+  seed_stream('combat')
+  seed_stream('ai')
   # Create the Player
   player = GameObject(0, 0, '@', 'player', libtcod.white, blocks=True)
   fighter_component = Fighter(player, hp = 100, defense = 1, power = 2, xp = 0, death_function = player_death)
+  player.equipment_stats = EquipmentStats()
   player.level = 1
+  light = Light()
   # Make the Map
   dungeon_level = 1
+  levels.open(archive, new = True)
   make_map()
   initialize_fov()
   # Set Game State
@@ -825,154 +2342,56 @@ def new_game():
   inventory.append(obj)
   equipment_component.equip()
 
+def object_record(obj):
+  # The saved form of a GameObject and its components (see savefile.py).
+  fighter = ai = item = equipment = status = None
+  if obj.fighter:
+    f = obj.fighter
+    fighter = (f.base_max_hp, f.hp, f.base_defense, f.base_power, f.base_dodge, f.xp, f.to_hit,
+      f.death_function.__name__ if f.death_function else None)
+  if obj.ai:
+    ai = ai_record(obj.ai)
+  if obj.item:
+    item = (obj.item.use_function.__name__ if obj.item.use_function else None,)
+  if obj.equipment:
+    e = obj.equipment
+    equipment = (e.slot, e.power_bonus, e.defense_bonus, e.max_hp_bonus, e.torch_bonus, e.dodge_bonus, e.is_equipped)
+  if obj.status_effect:
+    status = ('item_regen', obj.status_effect.amount, obj.status_effect.chance)
+  return (obj.x, obj.y, obj.char, obj.name, tuple(obj.color), obj.blocks, obj.always_visible, obj.level,
+    fighter, ai, item, equipment, status)
+
 def place_objects(room):
-  # Place items in the rooms.
-  global gameobjects
-
-  # Maximum number of monsters per room.
-  max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]])
-
-  # Chance of each given monster.
-  monster_chances = {}
-  monster_chances['orc'] = 80  # Orcs always shows up, even if all other monsters have 0 chance
-  monster_chances['troll'] = from_dungeon_level([[15, 3], [30, 5], [60, 7]])
-  monster_chances['kobold'] = from_dungeon_level([[50, 1], [10, 3], [0, 5]])
-  monster_chances['skeleton'] = from_dungeon_level([[45, 1], [15, 3], [5, 4]])
-  monster_chances['blink dog'] = from_dungeon_level([[15, 2], [30, 5], [45, 8]])
-
-  # Maximum number of items per room.
-  max_items = from_dungeon_level([[1, 1], [2, 4]])
-
-  # Chance of each item (by default they have a chance of 0 at level 1, which then goes up)
-  item_chances = {}
-  item_chances['healing potion'] = 35  #healing potion always shows up, even if all other items have 0 chance
-  item_chances['lightning scroll'] = from_dungeon_level([[25, 4]])
-  item_chances['fireball scroll'] =  from_dungeon_level([[25, 6]])
-  item_chances['confuse scroll'] =   from_dungeon_level([[10, 2]])
-  item_chances['sword'] =     from_dungeon_level([[5, 1], [10, 4]])
-  item_chances['wooden shield'] =    from_dungeon_level([[5, 1], [15, 4]])
-  item_chances['bronze shield'] =    from_dungeon_level([[5, 3], [10, 5]])
-  item_chances['cheap torch'] =      from_dungeon_level([[15, 1], [0, 3]])
-  item_chances['sword of flame'] =   from_dungeon_level([[10, 6]])
-  item_chances['wooden helm'] =      from_dungeon_level([[10, 1], [5, 3]])
-  item_chances['amulet of health'] = from_dungeon_level([[10, 5], [15, 8]])
-  item_chances['leather armor'] =    from_dungeon_level([[5, 1], [15, 3], [5, 5]])
-  item_chances['bronze armor'] =     from_dungeon_level([[5, 3], [15, 5]])
-  #item_chances['ring of lesser regeneration'] = from_dungeon_level([[200, 1]])
+  # Place monsters and items in a room, drawn from the current level's spawn tables.
+  (max_monsters, monster_table, max_items, item_table) = spawn_tables(dungeon_level)
 
   # Choose random number of monsters.
-  num_monsters = libtcod.random_get_int(0, 0, max_monsters)
+  num_monsters = libtcod.random_get_int(rng['spawn'], 0, max_monsters)
   for i in range(num_monsters):
     # Choose a random spot for each given monster.
-    x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-    y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+    x = libtcod.random_get_int(rng['spawn'], room.x1 + 1, room.x2 - 1)
+    y = libtcod.random_get_int(rng['spawn'], room.y1 + 1, room.y2 - 1)
 
     # Only place object if x, y is not blocked.
     if not is_blocked(x, y):
-      choice = random_choice(monster_chances)
-      # Create an orc.
-      if choice == 'orc':
-        monster = GameObject(x, y, 'o', 'orc', libtcod.desaturated_green, blocks = True)
-        fighter_component = Fighter(owner = monster, hp = 20, defense = 0, power = 4, xp = 35, death_function = monster_death)
-        ai_component = AI_BasicMonster(owner = monster)
-      # Create a troll.
-      elif choice == 'troll':
-        monster = GameObject(x, y, 'T', 'troll', libtcod.darker_green, blocks = True)
-        fighter_component = Fighter(monster, hp = 30, defense = 2, power = 8, xp = 100, death_function = monster_death)
-        ai_component = AI_BasicMonster(owner = monster)
-      # Create a kobold.
-      elif choice == 'kobold':
-        # Create more than one kobold in one monster 'slot.'
-        kobold_num = libtcod.random_get_int(0, 0, max_monsters)
-        for i in range(kobold_num + 1):
-          monster = GameObject(x, y, 'k', 'kobold', libtcod.darker_flame, blocks = True)
-          fighter_component = Fighter(monster, hp = 8, defense = 0, power = 3, xp = 20, death_function = monster_death)
-          ai_component = AI_BasicMonster(owner = monster)
-          # Append, unless last object in loop, then don't append because appendation (?) will happen after loop.
-          if i < kobold_num:
-            gameobjects.append(monster)
-      # Create a skeleton.
-      if choice == 'skeleton':
-        monster = GameObject(x, y, 'Z', 'skeleton', libtcod.white, blocks = True)
-        fighter_component = Fighter(monster, hp = 5, defense = 3, power = 3, xp = 25, death_function = monster_death)
-        ai_component = AI_BasicMonster(owner = monster)
-      # Create a skeleton.
-      if choice == 'blink dog':
-        monster = GameObject(x, y, 'b', 'blink dog', libtcod.dark_fuchsia, blocks = True)
-        fighter_component = Fighter(monster, hp = 20, defense = 0, power = 4, xp = 55, dodge = 20, death_function = monster_death)
-        ai_component = AI_BasicMonster(owner = monster)
-
-      gameobjects.append(monster)
+      template = monster_table.choose(rng['spawn'])
+      count = 1
+      if template.pack:
+        # Create more than one in one monster 'slot,' all on the same spot.
+        count += libtcod.random_get_int(rng['spawn'], 0, max_monsters)
+      add_objects(template.spawn_many([(x, y)] * count))
 
   # Choose random number of items.
-  num_items = libtcod.random_get_int(0, 0, max_items)
+  num_items = libtcod.random_get_int(rng['spawn'], 0, max_items)
   for i in range(num_items):
     # Choose random spot for this item.
-    x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-    y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+    x = libtcod.random_get_int(rng['spawn'], room.x1+1, room.x2-1)
+    y = libtcod.random_get_int(rng['spawn'], room.y1+1, room.y2-1)
     # Only place it if the tile is not blocked.
     if not is_blocked(x, y):
-      choice = random_choice(item_chances)
-      # Create a healing potion.
-      if choice == 'healing potion':
-        item = GameObject(x, y, '!', 'healing potion', libtcod.violet)
-        item_component = Item(owner = item, use_function = cast_heal)
-      elif choice == 'lightning scroll':
-        # Create a lightning bolt scroll.
-        item = GameObject(x, y, '#', 'scroll of lightning bolt', libtcod.light_yellow)
-        item_component = Item(owner = item, use_function = cast_heal)
-      # Create a confuse scroll.
-      elif choice == 'confuse scroll':
-        item = GameObject(x, y, '#', 'scroll of confusion', libtcod.light_yellow)
-        item_component = Item(owner = item, use_function = cast_confuse)
-      # Create a fireball scroll.
-      elif choice == 'fireball scroll':
-        item = GameObject(x, y, '#', 'scroll of fireball', libtcod.light_yellow)
-        item_component = Item(owner = item, use_function = cast_fireball)
-      # Create a sword.
-      elif choice == 'sword':
-        item = GameObject(x, y, '/', 'sword', libtcod.sky)
-        equipment_component = Equipment(owner = item, slot='right hand', power_bonus = 3)
-      # Create a wooden shield.
-      elif choice == 'wooden shield':
-        item = GameObject(x, y, '[', 'wooden shield', libtcod.darker_orange)
-        equipment_component = Equipment(owner = item, slot = 'left hand', dodge_bonus = 5)
-      # Create a bronze shield.
-      elif choice == 'bronze shield':
-        item = GameObject(x, y, '[', 'bronze shield', libtcod.sepia)
-        equipment_component = Equipment(owner = item, slot = 'left hand', dodge_bonus = 10)
-      # Create a torch.
-      elif choice == 'cheap torch':
-        item = GameObject(x, y, 'i', 'cheap torch', libtcod.dark_orange)
-        equipment_component = Equipment(owner = item, slot = 'left hand', torch_bonus = 2)
-      # Create a sword of flame.
-      elif choice == 'sword of flame':
-        item = GameObject(x, y, '/', 'sword of flame', libtcod.dark_orange)
-        equipment_component = Equipment(owner = item, slot = 'left hand', torch_bonus = 2, power_bonus = 3)
-      # Create a wooden helm.
-      elif choice == 'wooden helm':
-        item = GameObject(x, y, 'n', 'wooden helm', libtcod.darker_orange)
-        equipment_component = Equipment(owner = item, slot = 'head', defense_bonus = 1)
-      # Create an amulet of health.
-      elif choice == 'amulet of health':
-        item = GameObject(x, y, '\"', 'amulet of health', libtcod.darker_orange)
-        equipment_component = Equipment(owner = item, slot = 'neck', max_hp_bonus = 10)
-      # Create leather armor.
-      elif choice == 'leather armor':
-        item = GameObject(x, y, '[', 'leather armor', libtcod.desaturated_orange)
-        equipment_component = Equipment(owner = item, slot = 'chest', defense_bonus = 1)
-      # Create bronze armor.
-      elif choice == 'bronze armor':
-        item = GameObject(x, y, '[', 'bronze armor', libtcod.sepia)
-        equipment_component = Equipment(owner = item, slot = 'chest', defense_bonus = 3)
-      # Create ring of lesser regeneration.
-      #elif choice == 'ring of lesser regeneration':
-      #  item = GameObject(x, y, '=', 'ring of lesser regeneration', libtcod.sepia)
-      #  equipment_component = Equipment(owner = item, slot = 'finger')
-      #  status_component = Status_Item_Regen(item, 1, 100)
-
+      item = item_table.choose(rng['spawn']).spawn(x, y)
       # Add item to all gameobjects on map.
-      gameobjects.append(item)
+      add_object(item)
       item.send_to_back()  # Items appear below other gameobjects.
 
 def play_game():
@@ -980,27 +2399,59 @@ def play_game():
   player_action = None
   mouse = libtcod.Mouse()
   key = libtcod.Key()
+  render_invalidate()
+  if AUTOSAVE:
+    autosave.compact()
   # Play Game
   while not libtcod.console_is_window_closed():
-    # Render the screen.
-    libtcod.sys_check_for_event( libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
-    render_all()
-    libtcod.console_flush()
-    check_level_up()
-    for object in gameobjects:
-      object.clear()
-    # Handle key input and exit game if needed.
-    player_action = handle_keys()
+    with profiler.stage('frame'):
+      # Render the screen.
+      poll_input()
+      render_all()
+      with profiler.stage('flush'):
+        libtcod.console_flush()
+      check_level_up()
+      # Handle key input and exit game if needed.
+      player_action = play_turn()
     if player_action == 'exit':
+      # Save in full and wait for it to be written; the journal is no longer needed.
+      autosave.stop()
       save_game()
+      if saver.wait():
+        msgbox('\n The game could not be saved.\n', 30)
+      else:
+        for path in [JOURNAL_FILE, JOURNAL_FILE + '.new']:
+          if os.path.exists(path):
+            os.remove(path)
       break
-    # Let the monsters take their turn.
-    if game_state == 'playing' and player_action != 'didnt-take-turn':
-      for object in gameobjects:
-        if object.ai:
-          object.ai.take_turn()
-        if object.status_effect:
-          object.status_effect.take_turn()
+    if player_action != 'didnt-take-turn':
+      autosave.record_turn()
+    saver.poll()
+    pregen.prefetch(dungeon_level)
+  autosave.stop()
+  # Stop the level workers; the next game starts its own.
+  pregen.shutdown()
+
+def play_turn():
+  # Handle the player's input, then let the monsters take their turn. Returns the player's action.
+  player_action = handle_keys()
+  if player_action == 'exit':
+    return player_action
+  # Let the monsters take their turn.
+  if game_state == 'playing' and player_action != 'didnt-take-turn':
+    with profiler.stage('ai'):
+      # Only objects with an AI or a status effect take part, and of those with an AI, only the ones near the
+      # player (see Scheduler); one replaced or removed during the loop sits out.
+      ais = scheduler.turn()
+      # What the monsters that could see the player see, computed together before they act (see VisibilityService).
+      visibility.compute([(ai.owner.x, ai.owner.y) for ai in ais if ai.owner.distance_to(player) <= MONSTER_SIGHT_RADIUS])
+      for ai in ais:
+        if ai.owner.ai is ai:
+          ai.take_turn()
+      for effect in list(stores['status_effect'].components):
+        if effect.owner.status_effect is effect:
+          effect.take_turn()
+  return player_action
 
 def player_death(player):
   # Player dead. The game ended!
@@ -1010,6 +2461,8 @@ def player_death(player):
   # For added effect, transform the player into a corpse.
   player.char = '%'
   player.color = libtcod.dark_red
+  autosave.touch(player)
+  mark_dirty(player.x, player.y)
 
 def player_move_or_attack(dx, dy):
   global fov_recompute
@@ -1018,8 +2471,8 @@ def player_move_or_attack(dx, dy):
   y = player.y + dy
   # Check for attackable object at coordinates.
   target = None
-  for chk_object in gameobjects:
-    if chk_object.x == x and chk_object.y == y and chk_object.fighter:
+  for chk_object in occupancy.at(x, y):
+    if chk_object.fighter:
       target = chk_object
       break
   # Attack the target if found, otherwise move player.
@@ -1029,89 +2482,71 @@ def player_move_or_attack(dx, dy):
     player.move(dx, dy)
     fov_recompute = True
 
-def random_choice_index(chances):
-  # Choose one option from list of chances, returning its index
-  # The dice will land on some number between 1 and the sum of the chances.
-  dice = libtcod.random_get_int(0, 1, sum(chances))
-  # Go through all chances, keeping the sum so far.
-  running_sum = 0
-  choice = 0
-  for w in chances:
-    running_sum += w
-    # See if the dice landed in the part that corresponds to this choice.
-    if dice <= running_sum:
-      return choice
-    choice += 1
-
-def random_choice(chances_dict):
-  # Choose one option from dictionary of chances, returning its key.
-  chances = list(chances_dict.values())
-  strings = list(chances_dict.keys())
-  return strings[random_choice_index(chances)]
-
-def render_all():
-  global color_light_ground, color_light_wall
-  global color_dark_ground, color_dark_wall
-  global fov_recompute
-  global fov_map, map
-  global light
-
-  if fov_recompute:
-    # Recompute the FOV if needed (the player moved or something has changed the FOV)
-    fov_recompute = False
-    libtcod.map_compute_fov(fov_map, player.x, player.y, light.TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-  for y in range(MAP_HEIGHT):
-    for x in range(MAP_WIDTH):
-      visible = libtcod.map_is_in_fov(fov_map, x, y)
-      wall = map[x][y].block_sight
-      if not visible:
-        # This means it's outside of the player's FOV
-        if map[x][y].explored:
-          # Only render tiles outside FOV if they've been explored.
-          if wall:
-            libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-          else:
-            libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-      else:
-        # This means it's visible
-        if wall:
-          libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-        else:
-          libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-        # It is visible, and as such, has been explored.
-        map[x][y].explored = True
-
-  # Draw all gameobjects in the object list.
-  for object in gameobjects:
-    if object != player:
-      object.draw()
-    player.draw()
-
-  # Blit the contents of 'con' to the root console.
-  libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
-
-  # Prepare to render the GUI panel.
-  libtcod.console_set_default_background(panel, libtcod.black)
-  libtcod.console_clear(panel)
-
-  # Print the game messages, one line at a time.
-  y = 1
-  for (line, color) in game_msgs:
-    libtcod.console_set_default_foreground(panel, color)
-    libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
-    y += 1
+def poll_input():
+  # Read this frame's keyboard and mouse events into 'key' and 'mouse'.
+  if input_script is not None:
+    input_script.next_event(key, mouse)
+  else:
+    libtcod.sys_check_for_event( libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
 
-  # Show the player's stats.
-  render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp, libtcod.light_red, libtcod.darker_red)
-  libtcod.console_print_ex(panel, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Dungeon level ' + str(dungeon_level))
+def prev_level():
+  global dungeon_level
+  # Go back up to the previous level, from the archive.
+  levels.put(dungeon_level, level_record())
+  dungeon_level -= 1
+  message('You climb back up the stairs.', libtcod.red)
+  enter_level(levels.get(dungeon_level), 'stairs')
+  initialize_fov()
 
-  # Display names of gameobjects under the mouse.
-  libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-  libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+def random_moves(n, seed = None):
+  # Returns a script of n random arrow-key presses, for headless games; the same ones each time for a given seed.
+  directions = ['up', 'down', 'left', 'right']
+  moves = libtcod.random_new_buffered(seed) if seed is not None else 0
+  script = [directions[libtcod.random_get_int(moves, 0, 3)] for i in range(n)]
+  if seed is not None:
+    libtcod.random_delete(moves)
+  return script
+
+def read_fov(fov, x0, y0, width, height):
+  # The cells of a rectangle of an FOV map that are in its field of view, as bytes of 0 and 1 row by row. Read
+  # a row at a time where libtcodpy can, else cell by cell.
+  if libtcod.map_buffers_supported():
+    return libtcod.map_get_fov_window(fov, x0, y0, width, height)
+  cells = bytearray(width * height)
+  for y in range(height):
+    for x in range(width):
+      if libtcod.map_is_in_fov(fov, x0 + x, y0 + y):
+        cells[y * width + x] = 1
+  return bytes(cells)
+
+def redraw_cells(cells):
+  # Erase and redraw the objects on the given map cells. Returns the number of cells redrawn.
+  for i in cells:
+    x, y = i % map.width, i // map.width
+    libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+    objects_here = occupancy.at(x, y)
+    # Draw in list order, with the player on top.
+    for object in objects_here:
+      if object != player:
+        object.draw()
+    if player in objects_here:
+      player.draw()
+  return len(cells)
+
+def remove_object(obj):
+  # Take an object off the map.
+  gameobjects.remove(obj)
+  occupancy.remove(obj)
+  obj.place(False)
+  autosave.reorder(obj)
+  mark_dirty(obj.x, obj.y)
 
-  # Blit the contents of "panel" to the root console.
-  libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+def render_all():
+  changed = update_fov()
+  if headless:
+    return
+  with profiler.stage('render'):
+    draw_frame(changed)
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
   # Render a bar (e.g., HP, experience, etc). First; calculate the width of the bar:
@@ -1127,18 +2562,123 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
   libtcod.console_set_default_foreground(panel, libtcod.white)
   libtcod.console_print_ex(panel, x + total_width // 2, y, libtcod.BKGND_NONE, libtcod.CENTER, name + ': ' + str(value) + '/' + str(maximum))
 
-def save_game():
-  # Open a new empty shelve (possibly overwriting an old one) to write the game data.
-  file = shelve.open('savegame', 'n')
-  file['map'] = map
-  file['objects'] = gameobjects
-  file['player_index'] = gameobjects.index(player)  #index of player in gameobjects list
-  file['inventory'] = inventory
-  file['game_msgs'] = game_msgs
-  file['game_state'] = game_state
-  file['stairs_index'] = gameobjects.index(stairs)
-  file['dungeon_level'] = dungeon_level
-  file.close()
+def render_invalidate():
+  # The whole screen is stale (e.g. a menu was drawn over it), so redraw everything on the next frame.
+  global redraw_all
+  redraw_all = True
+
+def restore_state(snapshot):
+  # Replace the game state with a snapshot (see snapshot_state).
+  global map, gameobjects, stairs, upstairs, dungeon_level
+  global player, inventory
+  global game_msgs, game_state, light, game_seed
+  map = build_grid(snapshot['grid'])
+  objects = [build_object(record) for record in snapshot['objects']]
+  gameobjects = objects[:snapshot['map_count']]
+  inventory = objects[snapshot['map_count']:]
+  player = objects[snapshot['player']]
+  stairs = objects[snapshot['stairs']]
+  upstairs = objects[snapshot['upstairs']] if snapshot.get('upstairs', -1) >= 0 else None
+  game_msgs = [(line, libtcod.Color(*color)) for (line, color) in snapshot['messages']]
+  game_state = snapshot['game_state']
+  dungeon_level = snapshot['dungeon_level']
+  game_seed = snapshot.get('seed', 0)
+  # The game-long streams pick up from the save's epoch, so a given save always plays out the same way.
+  seed_stream('combat', snapshot.get('epoch', 0))
+  seed_stream('ai', snapshot.get('epoch', 0))
+  # Rebuild what isn't saved: the player's equipment bonuses, the occupancy index, the light and the FOV.
+  player.equipment_stats = EquipmentStats()
+  for obj in inventory:
+    if obj.equipment and obj.equipment.is_equipped:
+      player.equipment_stats.add(obj.equipment)
+  index_objects()
+  light = Light()
+  initialize_fov()
+
+def run_headless(events, max_turns = None):
+  # Play the current game without a window, taking input from a list of scripted events (see ScriptedInput).
+  # Stops when the script runs out, the player dies or quits, or after max_turns turns. Returns the number of turns played.
+  global key, mouse, input_script
+  input_script = ScriptedInput(events)
+  mouse = libtcod.Mouse()
+  key = libtcod.Key()
+  turns = 0
+  while game_state == 'playing' and not input_script.exhausted() and (max_turns is None or turns < max_turns):
+    poll_input()
+    update_fov()
+    check_level_up()
+    player_action = play_turn()
+    if player_action == 'exit':
+      break
+    if player_action != 'didnt-take-turn':
+      turns += 1
+  return turns
+
+def save_game(announce = True, journal = False):
+  # Take a snapshot of the game and have the save thread write it (see SaveWorker). The save gets a new epoch,
+  # which makes any older journal obsolete; 'journal' starts a new one for it. Returns the snapshot.
+  snapshot = snapshot_state()
+  snapshot['epoch'] = int.from_bytes(os.urandom(4), 'little')
+  saver.submit(snapshot, announce, journal)
+  return snapshot
+
+def saved_function(name):
+  # Returns the function a save refers to by name.
+  if name is None:
+    return None
+  if name not in SAVED_FUNCTIONS:
+    raise savefile.SaveFormatError('Unknown function in savegame: ' + name)
+  return globals()[name]
+
+def seed_stream(name, key = 0):
+  # (Re)start the named random number stream, from a seed derived from the game's seed, the stream's name and
+  # a key such as the dungeon level.
+  if name in rng:
+    libtcod.random_delete(rng[name])
+  rng[name] = libtcod.random_new_buffered(zlib.crc32((str(game_seed) + ':' + name + ':' + str(key)).encode('utf-8')))
+
+def slot_values(obj):
+  # The (name, value) of each slot that is set on an object with __slots__.
+  return [(name, getattr(obj, name)) for name in type(obj).__slots__ if hasattr(obj, name)]
+
+def snapshot_state():
+  # Copy the game state into plain data (a "snapshot", see savefile.py).
+  objects = gameobjects + inventory
+  snapshot = {
+    'grid': (map.width, map.height, combine_flags(map.blocked, map.block_sight, map.explored)),
+    'objects': [object_record(obj) for obj in objects],
+    'map_count': len(gameobjects),
+    'player': objects.index(player),
+    'stairs': objects.index(stairs),
+    'upstairs': objects.index(upstairs) if upstairs else -1,
+    'messages': [(line, tuple(color)) for (line, color) in game_msgs],
+    'dungeon_level': dungeon_level,
+    'game_state': game_state,
+    'seed': game_seed,
+    'levels': levels.serial,
+  }
+  return snapshot
+
+def spawn_tables(level):
+  # The room limits and spawn tables of a dungeon level: (max monsters, monster table, max items, item table).
+  # Compiled once per level (and monster density).
+  key = (level, MONSTER_DENSITY)
+  if key not in spawn_cache:
+    kinds = load_templates()
+    spawn_cache[key] = (int(round(from_dungeon_level(MAX_ROOM_MONSTERS, level) * MONSTER_DENSITY)),
+      SpawnTable([(template, from_dungeon_level(template.chance, level)) for template in kinds['monsters']]),
+      from_dungeon_level(MAX_ROOM_ITEMS, level),
+      SpawnTable([(template, from_dungeon_level(template.chance, level)) for template in kinds['items']]))
+  return spawn_cache[key]
+
+def sync_fov():
+  # Copy the tiles changed since the FOV map was made or last synced into it, so the player's FOV, the flow
+  # field and monster paths see the map as it is.
+  global fov_recompute
+  if map.changed:
+    libtcod.map_patch_cells(fov_map, sorted(map.changed), map.block_sight.translate(INVERT), map.blocked.translate(INVERT))
+    map.changed.clear()
+    fov_recompute = True
 
 def target_monster(max_range = None):
   # Returns a clicked monster within FOV and within a range, or None if right-clicked.
@@ -1147,8 +2687,8 @@ def target_monster(max_range = None):
     if x is None: # Player cancelled
       return None
     # Return first clicked monster, otherwise keep looping.
-    for obj in gameobjects:
-      if obj.x == x and obj.y == y and obj.fighter and obj != player:
+    for obj in occupancy.at(x, y):
+      if obj.fighter and obj != player:
         return obj
 
 def target_tile(max_range = None):
@@ -1156,8 +2696,9 @@ def target_tile(max_range = None):
   global key, mouse
   while True:
     # Render the screen. This erases the inventory and shows the names of gameobjects under the mouse.
-    libtcod.console_flush()
-    libtcod.sys_check_for_event( libtcod.EVENT_KEY_PRESS | libtcod.EVENT_MOUSE, key, mouse)
+    if not headless:
+      libtcod.console_flush()
+    poll_input()
     render_all()
     (x, y) = (mouse.cx, mouse.cy)
 
@@ -1169,14 +2710,80 @@ def target_tile(max_range = None):
     if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and (max_range is None or player.distance(x, y) <= max_range)):
       return (x, y)
 
+def update_fov():
+  # Recompute the FOV if needed (the player moved or something has changed the FOV).
+  # Returns the cells whose visibility changed, or None if nothing was recomputed.
+  global fov_recompute
+  sync_fov()
+  if not fov_recompute:
+    return None
+  fov_recompute = False
+  radius = light.TORCH_RADIUS
+  with profiler.stage('fov'):
+    libtcod.map_compute_fov(fov_map, player.x, player.y, radius, FOV_LIGHT_WALLS, FOV_ALGO)
+    old_visible = bytes(map.visible)
+    update_visible(radius)
+  # Everything visible has now been explored.
+  map.explored[:] = bytes_or(map.explored, map.visible)
+  changed = changed_cells(old_visible, map.visible)
+  autosave.touch_cells(changed)
+  return changed
+
+def update_visible(radius):
+  # Copy the player's FOV into map.visible. Only cells within the light radius can be lit, so only those are read.
+  if libtcod.map_buffers_supported():
+    map.visible[:] = libtcod.map_get_fov_buffer(fov_map)
+    return
+  map.visible[:] = bytes(len(map.visible))
+  if radius > 0:
+    x0, y0 = max(0, player.x - radius), max(0, player.y - radius)
+    width = min(map.width, player.x + radius + 1) - x0
+    height = min(map.height, player.y + radius + 1) - y0
+  else:
+    x0, y0, width, height = 0, 0, map.width, map.height
+  cells = read_fov(fov_map, x0, y0, width, height)
+  for y in range(height):
+    map.visible[map.index(x0, y0 + y):map.index(x0, y0 + y) + width] = cells[y * width:(y + 1) * width]
+
+def wait_for_keypress():
+  # Wait for a key-press and return it. Scripted games take the next scripted key, or 'a' if the script has run out
+  # or goes on with a move.
+  if input_script is not None:
+    key = libtcod.Key()
+    input_script.next_event(key, libtcod.Mouse(), 'a', menu = True)
+    return key
+  return libtcod.console_wait_for_keypress(True)
+
+def write_save(snapshot):
+  # Write the game data to a new file, then put it in place of the old save, so a failed save can't corrupt it.
+  with open(SAVE_FILE + '.tmp', 'wb') as f:
+    savefile.write(f, snapshot)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(SAVE_FILE + '.tmp', SAVE_FILE)
+
 #############################################
 # Initialization of Main Loop
 #############################################
 
-libtcod.console_set_custom_font(b'arial12x12.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, b'python/libtcod tutorial', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-main_menu()
+if __name__ == '__main__':
+  if '--seed' in sys.argv:
+    # Replay the same games: rl.py --seed N ...
+    GAME_SEED = int(sys.argv.pop(sys.argv.index('--seed') + 1)) & 0xFFFFFFFF
+    sys.argv.remove('--seed')
+  if '--headless' in sys.argv:
+    # Play random games without a window: rl.py --headless [games] [turns]
+    args = [int(arg) for arg in sys.argv[sys.argv.index('--headless') + 1:]]
+    games = args[0] if len(args) > 0 else 100
+    turns = args[1] if len(args) > 1 else 500
+    init_console(headless_mode = True)
+    for game in range(games):
+      seed = GAME_SEED + game if GAME_SEED is not None else None
+      new_game(seed)
+      played = run_headless(random_moves(turns, seed))
+      print('Game ' + str(game + 1) + ': ' + str(played) + ' turns, dungeon level ' + str(dungeon_level) + ', ' + game_state)
+  else:
+    if '--profile' in sys.argv:
+      profiler.enable()
+    init_console()
+    main_menu()
@@ -0,0 +1,390 @@
+import struct
+import zlib
+
+#############################################
+# Binary savegame format.
+#
+# A save file is the magic b'RLSV' and a format version, followed by sections. Each section is a 4-byte tag,
+# the payload length and the payload, so a reader can skip sections it doesn't know. The string table comes
+# first; every other section refers to strings by their index in it (-1 for None).
+#
+# The game state is passed around as a "snapshot": plain data that rl.py builds (snapshot_state) and restores
+# (restore_state). Keys of a snapshot, all optional:
+#   'grid':          (width, height, flags), flags holding blocked | block_sight << 1 | explored << 2 per cell
+#   'objects':       list of object records (see below); the first 'map_count' are on the map, the rest in
+#                    the inventory. 'player', 'stairs' and 'upstairs' are indexes into this list, or -1.
+#   'messages':      list of (line, (r, g, b))
+#   'dungeon_level', 'game_state'
+#   'seed':          the game's seed, from which each level's map is generated
+#   'epoch':         a number identifying this save, which its journal must match (see below)
+#   'levels':        the number of level records written to the level archive when the save was made
+#
+# An object record is (x, y, char, name, (r, g, b), blocks, always_visible, level, fighter, ai, item,
+# equipment, status), where the components are None or:
+#   fighter:   (base_max_hp, hp, base_defense, base_power, base_dodge, xp, to_hit, death_function name)
+#   ai:        (kind, num_turns, old kind)
+#   item:      (use_function name,)
+#   equipment: (slot, power_bonus, defense_bonus, max_hp_bonus, torch_bonus, dodge_bonus, is_equipped)
+#   status:    (kind, amount, chance)
+#
+# Autosave journal: a file next to the save holding the changes made since it was written, one "delta" per
+# turn. It starts with the magic b'RLJN' and the epoch of the save it applies to, then each delta is its length
+# followed by the delta encoded like a snapshot. Objects in a delta are identified by "slots": an object's
+# index in the save's object list, or a new number for objects created since. Keys of a delta:
+#   'tiles':      list of (cell index, flags) for changed cells
+#   'objects':    records of new or changed objects, and 'slots': the slot of each
+#   'removed':    slots of objects that are gone
+#   'map_order', 'inventory_order': slots in the new order, when it changed
+#   'player', 'stairs', 'upstairs': slots, or -1
+#   'messages', 'dungeon_level', 'game_state': as in a snapshot
+#
+# Level archive: the levels the player has left, so they can be revisited. It is a series of records, each the
+# level number, a serial number and the length of the level encoded like a snapshot (with 'grid', 'objects',
+# 'stairs', 'upstairs' and 'dungeon_level', and no player). Serial numbers count the records written in the
+# game, so a save's 'levels' tells which records it knows of: those written later belong to a newer save and
+# are dropped when it is loaded. A level left more than once has several records; the last one counts, and
+# older ones are dropped when the archive is compacted, which keeps the serial numbers of the rest.
+#############################################
+
+MAGIC = b'RLSV'
+VERSION = 1
+JOURNAL_MAGIC = b'RLJN'
+
+SECTION_HEADER = struct.Struct('<4sI')
+COUNT = struct.Struct('<I')
+GRID = struct.Struct('<HH')
+OBJECTS = struct.Struct('<IIii')  # count, map_count, player, stairs
+OBJECT = struct.Struct('<hhiiBBBBH')  # x, y, char, name, r, g, b, flags, level
+FIGHTER = struct.Struct('<Iiiiiiiii')
+AI = struct.Struct('<Iiih')
+ITEM = struct.Struct('<Ii')
+EQUIPMENT = struct.Struct('<IiiiiiiB')
+STATUS = struct.Struct('<Iiii')
+MESSAGE = struct.Struct('<iBBB')
+GAME = struct.Struct('<Hi')
+TILE = struct.Struct('<IB')
+SLOT = struct.Struct('<I')
+INDEX = struct.Struct('<i')
+LEVEL = struct.Struct('<HII')  # dungeon level, serial, length
+
+# Object flags.
+BLOCKS = 1
+ALWAYS_VISIBLE = 2
+
+class SaveFormatError(Exception):
+  pass
+
+class StringTable:
+  # Collects the strings used by the records being encoded, storing each one once.
+  def __init__(self, strings = None):
+    self.strings = strings if strings is not None else []
+    self.indexes = {}
+
+  def add(self, string):
+    if string is None:
+      return -1
+    index = self.indexes.get(string)
+    if index is None:
+      index = len(self.strings)
+      self.strings.append(string)
+      self.indexes[string] = index
+    return index
+
+  def get(self, index):
+    if index < 0:
+      return None
+    return self.strings[index]
+
+def append_delta(f, delta):
+  # Add one delta to a journal opened in binary mode.
+  data = dumps(delta)
+  f.write(COUNT.pack(len(data)) + data)
+
+def append_level(f, level, serial, record):
+  # Add a level record to an archive opened in binary mode. Returns the (offset, length) of the encoded level.
+  data = dumps(record)
+  offset = f.seek(0, 2) + LEVEL.size
+  f.write(LEVEL.pack(level, serial, len(data)) + data)
+  return (offset, len(data))
+
+def apply_deltas(snapshot, deltas):
+  # Replay journal deltas on top of a snapshot, returning the resulting snapshot.
+  objects = snapshot['objects']
+  records = dict(enumerate(objects))
+  map_order = list(range(snapshot['map_count']))
+  inventory_order = list(range(snapshot['map_count'], len(objects)))
+  player = snapshot['player']
+  stairs = snapshot['stairs']
+  upstairs = snapshot.get('upstairs', -1)
+  (width, height, flags) = snapshot['grid']
+  flags = bytearray(flags)
+  result = dict(snapshot)
+  for delta in deltas:
+    for (i, cell) in delta.get('tiles', []):
+      flags[i] = cell
+    for (slot, record) in zip(delta.get('slots', []), delta.get('objects', [])):
+      records[slot] = record
+    for slot in delta.get('removed', []):
+      records.pop(slot, None)
+    map_order = delta.get('map_order', map_order)
+    inventory_order = delta.get('inventory_order', inventory_order)
+    player = delta.get('player', player)
+    stairs = delta.get('stairs', stairs)
+    upstairs = delta.get('upstairs', upstairs)
+    for key in ['messages', 'dungeon_level', 'game_state']:
+      if key in delta:
+        result[key] = delta[key]
+  order = map_order + inventory_order
+  result['grid'] = (width, height, bytes(flags))
+  result['objects'] = [records[slot] for slot in order]
+  result['map_count'] = len(map_order)
+  result['player'] = order.index(player)
+  result['stairs'] = order.index(stairs)
+  result['upstairs'] = order.index(upstairs) if upstairs >= 0 else -1
+  return result
+
+def copy_levels(data, index, f):
+  # Write the records an archive's index points to (see scan_levels) to a new archive file, keeping their
+  # serial numbers. Returns the index of the new file.
+  copied = {}
+  for (level, (offset, length)) in sorted(index.items(), key = lambda item: item[1][0]):
+    copied[level] = (f.tell() + LEVEL.size, length)
+    f.write(data[offset - LEVEL.size:offset + length])
+  return copied
+
+def decode_grid(payload):
+  (width, height) = GRID.unpack_from(payload)
+  return (width, height, zlib.decompress(payload[GRID.size:]))
+
+def decode_objects(payload, strings, snapshot):
+  (count, map_count, player, stairs) = OBJECTS.unpack_from(payload)
+  records = []
+  offset = OBJECTS.size
+  for i in range(count):
+    (x, y, char, name, r, g, b, flags, level) = OBJECT.unpack_from(payload, offset)
+    offset += OBJECT.size
+    # Components are filled in by their own sections.
+    records.append([x, y, strings.get(char), strings.get(name), (r, g, b), bool(flags & BLOCKS), bool(flags & ALWAYS_VISIBLE),
+      level, None, None, None, None, None])
+  snapshot['objects'] = records
+  snapshot['map_count'] = map_count
+  snapshot['player'] = player
+  snapshot['stairs'] = stairs
+
+def decode_rows(payload, row):
+  # Yields the fixed-size rows of a component table.
+  (count,) = COUNT.unpack_from(payload)
+  for i in range(count):
+    yield row.unpack_from(payload, COUNT.size + i * row.size)
+
+def decode_slots(payload):
+  return [slot for (slot,) in decode_rows(payload, SLOT)]
+
+def decode_strings(payload):
+  (count,) = COUNT.unpack_from(payload)
+  offset = COUNT.size
+  strings = []
+  for i in range(count):
+    (length,) = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    strings.append(payload[offset:offset + length].decode('utf-8'))
+    offset += length
+  return StringTable(strings)
+
+def encode_grid(grid):
+  (width, height, flags) = grid
+  return GRID.pack(width, height) + zlib.compress(bytes(flags))
+
+def encode_objects(snapshot, strings):
+  # Returns the payloads of the object section and of each component table.
+  records = snapshot['objects']
+  objects = [OBJECTS.pack(len(records), snapshot.get('map_count', len(records)), snapshot.get('player', -1), snapshot.get('stairs', -1))]
+  fighters, ais, items, equipments, statuses = [], [], [], [], []
+  for (i, record) in enumerate(records):
+    (x, y, char, name, color, blocks, always_visible, level, fighter, ai, item, equipment, status) = record
+    flags = (BLOCKS if blocks else 0) | (ALWAYS_VISIBLE if always_visible else 0)
+    objects.append(OBJECT.pack(x, y, strings.add(char), strings.add(name), color[0], color[1], color[2], flags, level))
+    if fighter:
+      fighters.append(FIGHTER.pack(i, *(fighter[:7] + (strings.add(fighter[7]),))))
+    if ai:
+      ais.append(AI.pack(i, strings.add(ai[0]), strings.add(ai[2]), ai[1]))
+    if item:
+      items.append(ITEM.pack(i, strings.add(item[0])))
+    if equipment:
+      equipments.append(EQUIPMENT.pack(i, strings.add(equipment[0]), *equipment[1:]))
+    if status:
+      statuses.append(STATUS.pack(i, strings.add(status[0]), status[1], status[2]))
+  sections = [(b'OBJS', b''.join(objects))]
+  for (tag, rows) in [(b'FGHT', fighters), (b'AI__', ais), (b'ITEM', items), (b'EQUP', equipments), (b'EFCT', statuses)]:
+    sections.append((tag, COUNT.pack(len(rows)) + b''.join(rows)))
+  return sections
+
+def encode_slots(slots):
+  return COUNT.pack(len(slots)) + b''.join(SLOT.pack(slot) for slot in slots)
+
+def encode_strings(strings):
+  parts = [COUNT.pack(len(strings.strings))]
+  for string in strings.strings:
+    data = string.encode('utf-8')
+    parts.append(struct.pack('<H', len(data)) + data)
+  return b''.join(parts)
+
+def dumps(snapshot):
+  # Encode a snapshot to bytes.
+  parts = []
+  write_sections(parts.append, snapshot)
+  return b''.join(parts)
+
+def loads(data):
+  # Decode a snapshot from bytes.
+  offset = 0
+  def read(size):
+    nonlocal offset
+    chunk = data[offset:offset + size]
+    offset += size
+    return chunk
+  return read_sections(read)
+
+def read(f):
+  # Read a snapshot from a file opened in binary mode, one section at a time.
+  return read_sections(f.read)
+
+def read_journal(f):
+  # Read a journal opened in binary mode. Returns (epoch, deltas); a delta cut short by a crash is ignored.
+  header = f.read(len(JOURNAL_MAGIC) + COUNT.size)
+  if len(header) < len(JOURNAL_MAGIC) + COUNT.size or header[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+    raise SaveFormatError('Not a savegame journal.')
+  (epoch,) = COUNT.unpack(header[len(JOURNAL_MAGIC):])
+  deltas = []
+  while True:
+    length = f.read(COUNT.size)
+    if len(length) < COUNT.size:
+      break
+    data = f.read(COUNT.unpack(length)[0])
+    try:
+      deltas.append(loads(data))
+    except (SaveFormatError, struct.error, zlib.error):
+      break
+  return (epoch, deltas)
+
+def read_sections(read):
+  header = read(len(MAGIC) + 2)
+  if len(header) < len(MAGIC) + 2 or header[:len(MAGIC)] != MAGIC:
+    raise SaveFormatError('Not a savegame.')
+  (version,) = struct.unpack('<H', header[len(MAGIC):])
+  if version > VERSION:
+    raise SaveFormatError('Savegame version ' + str(version) + ' is newer than this game.')
+  snapshot = {}
+  strings = StringTable()
+  while True:
+    header = read(SECTION_HEADER.size)
+    if not header:
+      break
+    if len(header) < SECTION_HEADER.size:
+      raise SaveFormatError('Truncated savegame.')
+    (tag, length) = SECTION_HEADER.unpack(header)
+    payload = read(length)
+    if len(payload) < length:
+      raise SaveFormatError('Truncated savegame.')
+    if tag == b'STRS':
+      strings = decode_strings(payload)
+    elif tag == b'GRID':
+      snapshot['grid'] = decode_grid(payload)
+    elif tag == b'OBJS':
+      decode_objects(payload, strings, snapshot)
+    elif tag == b'FGHT':
+      for row in decode_rows(payload, FIGHTER):
+        snapshot['objects'][row[0]][8] = row[1:8] + (strings.get(row[8]),)
+    elif tag == b'AI__':
+      for (i, kind, old_kind, num_turns) in decode_rows(payload, AI):
+        snapshot['objects'][i][9] = (strings.get(kind), num_turns, strings.get(old_kind))
+    elif tag == b'ITEM':
+      for (i, use) in decode_rows(payload, ITEM):
+        snapshot['objects'][i][10] = (strings.get(use),)
+    elif tag == b'EQUP':
+      for row in decode_rows(payload, EQUIPMENT):
+        snapshot['objects'][row[0]][11] = (strings.get(row[1]),) + row[2:7] + (bool(row[7]),)
+    elif tag == b'EFCT':
+      for (i, kind, amount, chance) in decode_rows(payload, STATUS):
+        snapshot['objects'][i][12] = (strings.get(kind), amount, chance)
+    elif tag == b'MSGS':
+      snapshot['messages'] = [(strings.get(line), (r, g, b)) for (line, r, g, b) in decode_rows(payload, MESSAGE)]
+    elif tag == b'GAME':
+      (snapshot['dungeon_level'], game_state) = GAME.unpack(payload)
+      snapshot['game_state'] = strings.get(game_state)
+    elif tag == b'UPST':
+      (snapshot['upstairs'],) = INDEX.unpack(payload)
+    elif tag == b'SEED':
+      (snapshot['seed'],) = COUNT.unpack(payload)
+    elif tag == b'EPCH':
+      (snapshot['epoch'],) = COUNT.unpack(payload)
+    elif tag == b'LVLS':
+      (snapshot['levels'],) = COUNT.unpack(payload)
+    elif tag == b'TILE':
+      snapshot['tiles'] = list(decode_rows(payload, TILE))
+    elif tag == b'SLOT':
+      snapshot['slots'] = decode_slots(payload)
+    elif tag == b'GONE':
+      snapshot['removed'] = decode_slots(payload)
+    elif tag == b'MORD':
+      snapshot['map_order'] = decode_slots(payload)
+    elif tag == b'IORD':
+      snapshot['inventory_order'] = decode_slots(payload)
+  if 'objects' in snapshot:
+    snapshot['objects'] = [tuple(record) for record in snapshot['objects']]
+  return snapshot
+
+def scan_levels(data, limit = None):
+  # Index an archive's contents (bytes, or a memory map of the file), stopping at the first record whose serial
+  # number is 'limit' or more, or one cut short by a crash. Returns ({level: (offset, length)} of each level's last
+  # record, the offset where the records stopped, the serial number of the next record).
+  index = {}
+  offset = 0
+  serial = 0
+  while offset + LEVEL.size <= len(data):
+    (level, record_serial, length) = LEVEL.unpack_from(data, offset)
+    if (limit is not None and record_serial >= limit) or offset + LEVEL.size + length > len(data):
+      break
+    index[level] = (offset + LEVEL.size, length)
+    offset += LEVEL.size + length
+    serial = record_serial + 1
+  return (index, offset, serial if limit is None else limit)
+
+def write(f, snapshot):
+  # Write a snapshot to a file opened in binary mode, one section at a time.
+  write_sections(f.write, snapshot)
+
+def write_journal_header(f, epoch):
+  # Start a journal for the save with the given epoch.
+  f.write(JOURNAL_MAGIC + COUNT.pack(epoch))
+
+def write_sections(write, snapshot):
+  # Records are encoded first, since the string table they fill in has to come before them.
+  strings = StringTable()
+  sections = []
+  if 'grid' in snapshot:
+    sections.append((b'GRID', encode_grid(snapshot['grid'])))
+  if 'objects' in snapshot:
+    sections.extend(encode_objects(snapshot, strings))
+  if 'messages' in snapshot:
+    rows = [MESSAGE.pack(strings.add(line), color[0], color[1], color[2]) for (line, color) in snapshot['messages']]
+    sections.append((b'MSGS', COUNT.pack(len(rows)) + b''.join(rows)))
+  if 'dungeon_level' in snapshot:
+    sections.append((b'GAME', GAME.pack(snapshot['dungeon_level'], strings.add(snapshot.get('game_state')))))
+  if 'upstairs' in snapshot:
+    sections.append((b'UPST', INDEX.pack(snapshot['upstairs'])))
+  if 'seed' in snapshot:
+    sections.append((b'SEED', COUNT.pack(snapshot['seed'])))
+  if 'epoch' in snapshot:
+    sections.append((b'EPCH', COUNT.pack(snapshot['epoch'])))
+  if 'levels' in snapshot:
+    sections.append((b'LVLS', COUNT.pack(snapshot['levels'])))
+  if 'tiles' in snapshot:
+    sections.append((b'TILE', COUNT.pack(len(snapshot['tiles'])) + b''.join(TILE.pack(i, cell) for (i, cell) in snapshot['tiles'])))
+  for (tag, key) in [(b'SLOT', 'slots'), (b'GONE', 'removed'), (b'MORD', 'map_order'), (b'IORD', 'inventory_order')]:
+    if key in snapshot:
+      sections.append((tag, encode_slots(snapshot[key])))
+  write(MAGIC + struct.pack('<H', VERSION))
+  for (tag, payload) in [(b'STRS', encode_strings(strings))] + sections:
+    write(SECTION_HEADER.pack(tag, len(payload)))
+    write(payload)